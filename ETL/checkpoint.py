@@ -0,0 +1,85 @@
+'''
+Checkpoint file for resumable loadSync.py runs.
+
+Records the byte offset in the input feed up to which every batch has been
+acknowledged by the sync API, together with the running totals for those
+batches. Batches are posted concurrently and may complete out of order, so
+the offset only moves forward once every earlier batch has completed too;
+resuming from it never skips a customer that was not acknowledged.
+'''
+
+import json
+import os
+import threading
+
+
+class CheckpointMismatch(Exception):
+    '''
+    Raised when a checkpoint was written for a different input or app group.
+    '''
+
+
+class Checkpoint(object):
+    '''
+    Acknowledged position and totals of a loadSync.py run, saved after each batch.
+    '''
+
+    def __init__(self, path, input_file, app_group_name, offset=0, counts=None):
+        self.path = path
+        self.input_file = input_file
+        self.app_group_name = app_group_name
+        self.offset = offset
+        self.counts = counts or {'updated_count': 0, 'created_count': 0, 'error_count': 0}
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.completed = {}
+
+    @classmethod
+    def load(cls, path, input_file, app_group_name):
+        '''
+        Read the checkpoint left by an earlier run over the same input.
+        A missing checkpoint file starts from the beginning of the feed.
+        :raise CheckpointMismatch: if the checkpoint belongs to another run
+        '''
+        if not os.path.exists(path):
+            return cls(path, input_file, app_group_name)
+        with open(path, 'r') as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if state['input_file'] != input_file or state['app_group'] != app_group_name:
+            raise CheckpointMismatch("Checkpoint {} was written for {} ({}), not {} ({})".format(
+                path, state['input_file'], state['app_group'], input_file, app_group_name))
+        return cls(path, input_file, app_group_name, state['offset'], state['counts'])
+
+    def acknowledge(self, seq, end_offset, counts):
+        '''
+        Record a completed batch and save the checkpoint if the acknowledged prefix grew.
+        :param seq: position of the batch in submission order, starting at 0
+        :param end_offset: input byte offset just past the batch's last line
+        :param counts: sync API response for the batch
+        '''
+        with self.lock:
+            self.completed[seq] = (end_offset, counts)
+            if self.next_seq not in self.completed:
+                return
+            while self.next_seq in self.completed:
+                end_offset, counts = self.completed.pop(self.next_seq)
+                self.offset = end_offset
+                for key in self.counts:
+                    self.counts[key] += counts[key]
+                self.next_seq += 1
+            self.save()
+
+    def save(self):
+        '''
+        Atomically replace the checkpoint file with the current state.
+        '''
+        state = {
+            'input_file': self.input_file,
+            'app_group': self.app_group_name,
+            'offset': self.offset,
+            'counts': self.counts
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.rename(tmp_path, self.path)
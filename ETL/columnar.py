@@ -0,0 +1,100 @@
+'''
+Columnar transform engine for loadSync.py (--engine columnar).
+
+The default engine builds a customer dict (with its nested properties) for every
+row with the compiled feed mapping and hands it to json.dumps. This engine
+instead reads the feed in blocks of BLOCK_ROWS lines, picks the mapped columns
+of the block by position into columns, coerces and JSON-encodes each column
+with one map() call and fills a record template, so no per-row dicts are ever
+built.
+
+The template is produced by json.dumps itself from a customer dict laid out by
+the same mapping, and the values are encoded with the same encoder json.dumps
+uses, so the records are byte for byte identical to the default engine's.
+'''
+
+from itertools import islice
+from json.encoder import encode_basestring
+from operator import itemgetter
+import json
+
+from schema_mapping import COERCE, Const, compile_mapping, parse_mapping
+
+BLOCK_ROWS = 10000 #feed lines transformed per block
+
+
+def record_template(mapping):
+    '''
+    %-format template of one serialized customer.
+    Constants of the mapping are written into the template.
+    :return: (template, indexes of the mapping entries filling its %s slots, in order)
+    '''
+    entries = parse_mapping(mapping)
+    placeholders = {}
+    layout = []
+    for i, (path, source, type) in enumerate(entries):
+        value = u'\x01%d\x01' % i
+        placeholders[json.dumps(value, ensure_ascii=False)] = (i, source, type)
+        layout.append((u'.'.join(path), Const(value)))
+    template = json.dumps(compile_mapping(layout)({}), ensure_ascii=False).replace('%', '%%')
+    order = []
+    for encoded, (i, source, type) in sorted(placeholders.items(), key=lambda item: template.index(item[0])):
+        if isinstance(source, Const):
+            value = COERCE[type](source.value) if type != 'str' else source.value
+            template = template.replace(encoded, json.dumps(value, ensure_ascii=False).replace('%', '%%'))
+            continue
+        template = template.replace(encoded, '%s')
+        order.append(i)
+    return template, order
+
+
+def column_encoder(type):
+    '''
+    Function JSON-encoding one raw (unicode) column value of the given mapping type.
+    '''
+    if type == 'str':
+        return encode_basestring
+    coerce = COERCE[type]
+    return lambda value: json.dumps(coerce(value), ensure_ascii=False)
+
+
+def columnar_records(lines, mapping, offset=0, row_filter=None, block_rows=BLOCK_ROWS):
+    '''
+    Serialize feed lines to customer records a block at a time.
+    Produces the same records as serializing parse_customers' dicts.
+    :param lines: iterator over raw (latin-1 encoded) lines, header already consumed
+    :param mapping: feed mapping, column positions to customer keys (see lambda/schema_mapping.py)
+    :param offset: byte offset of the first line in the feed
+    :param row_filter: optional callable given each raw line, lines it returns False for are skipped
+    :return: generator of (latin-1 encoded JSON record, byte offset just past its line, customer id)
+    '''
+    entries = parse_mapping(mapping)
+    template, order = record_template(mapping)
+    pick = itemgetter(*[entries[i][1] for i in order])
+    encoders = [column_encoder(entries[i][2]) for i in order]
+    targets = [entries[i][0] for i in order]
+    id_column = targets.index((u'id',)) if (u'id',) in targets else None
+    fill = template.__mod__
+    while True:
+        block = list(islice(lines, block_rows))
+        if not block:
+            return
+        rows = []
+        offsets = []
+        for line in block:
+            offset += len(line)
+            line = line.rstrip()
+            if not line or (row_filter is not None and not row_filter(line)):
+                continue
+            rows.append(line)
+            offsets.append(offset)
+        if not rows:
+            continue
+        rows = [pick(line.decode('latin-1').split(';')) for line in rows]
+        if len(order) == 1: #itemgetter of one item returns the value, not a tuple
+            rows = [(value,) for value in rows]
+        columns = [map(encode, column) for encode, column in zip(encoders, zip(*rows))]
+        records = [record.encode('latin-1') for record in map(fill, zip(*columns))]
+        ids = [row[id_column] for row in rows] if id_column is not None else [None] * len(rows)
+        for record in zip(records, offsets, ids):
+            yield record
@@ -0,0 +1,59 @@
+'''
+Streaming decompression of compressed feeds (.gz, .bz2, .xz).
+
+Compressed exports no longer need unpacking to disk first: blocks read from the
+file or the HTTP response are decompressed as they arrive, so memory stays flat.
+Concatenated streams (as produced by pigz, pbzip2 or `cat a.gz b.gz`) are handled.
+.xz needs the lzma module (backports.lzma on Python 2).
+'''
+
+import bz2
+import urlparse
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+def decompressor_for(in_obj):
+    '''
+    Decompressor factory matching the extension of a feed path or URL.
+    :return: callable returning a fresh decompressor, or None for plain feeds
+    '''
+    path = urlparse.urlparse(in_obj).path if in_obj.startswith('http') else in_obj
+    if path.endswith('.gz'):
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if path.endswith('.bz2'):
+        return bz2.BZ2Decompressor
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise ValueError("Reading .xz feeds needs the lzma module: pip install backports.lzma")
+        return lzma.LZMADecompressor
+    return None
+
+
+def decompress_chunks(chunks, new_decompressor):
+    '''
+    Decompress a stream of compressed byte blocks.
+    :param chunks: iterator of compressed blocks
+    :param new_decompressor: factory as returned by decompressor_for
+    :return: generator of decompressed blocks
+    '''
+    decompressor = new_decompressor()
+    for data in chunks:
+        while data:
+            try:
+                out = decompressor.decompress(data)
+            except EOFError: #previous stream finished exactly at a block boundary
+                decompressor = new_decompressor()
+                continue
+            if out:
+                yield out
+            data = decompressor.unused_data
+            if data: #another stream follows the one that just ended
+                decompressor = new_decompressor()
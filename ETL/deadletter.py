@@ -0,0 +1,51 @@
+'''
+Dead-letter file for batches the sync API would not accept.
+
+Each line is a JSON object holding the request body exactly as it was posted
+(decoded as latin-1 so it round-trips byte for byte), the input offset of the
+batch, the sync state entries to record once it goes through, and the last
+error. `python loadSync.py --replay <file>` posts them again.
+'''
+
+import json
+import threading
+
+
+class DeadLetterFile(object):
+    '''
+    Append-only JSONL file of failed batches, safe to write from several threads.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.dead_file = None
+
+    def write(self, payload_json, end_offset, synced, error):
+        with self.lock:
+            if self.dead_file is None: #only create the file once something fails
+                self.dead_file = open(self.path, 'a')
+            record = {'payload': payload_json.decode('latin-1'), 'end_offset': end_offset,
+                      'synced': synced, 'error': str(error)}
+            self.dead_file.write(json.dumps(record) + '\n')
+            self.dead_file.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.dead_file is not None:
+                self.dead_file.close()
+                self.dead_file = None
+
+
+def read_dead_letters(path):
+    '''
+    Read back the batches of a dead-letter file.
+    :return: generator of (payload, end offset, sync state entries) as accepted by submit_payloads
+    '''
+    with open(path, 'r') as dead_file:
+        for line in dead_file:
+            if line.strip():
+                record = json.loads(line)
+                yield record['payload'].encode('latin-1'), record['end_offset'], record.get('synced', [])
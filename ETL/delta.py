@@ -0,0 +1,195 @@
+'''
+Delta mode for loadSync.py: only send rows that changed since the previous run.
+
+The previous run is remembered as a compact snapshot on disk:
+  <snapshot>.idx  fixed 16-byte records (id hash, row hash), sorted by id hash
+  <snapshot>.ids  the customer ids, one per line, in the same order
+The .idx file is memory-mapped and binary searched for every row of the new
+feed, so neither run is ever loaded into a Python dict. Rows whose id is not in
+the snapshot, or whose row hash differs, are passed on to be synced.
+
+The snapshot of the current run is built alongside: (id hash, position in the
+feed, row hash, id) tuples are sorted in runs of RUN_ROWS in memory (about 50MB
+at the default, --delta-run-rows changes it), spilled to temporary files and
+merged at the end, so memory stays bounded whatever the feed size. An id that
+appears on several rows keeps the hash of its first row. The new
+snapshot only replaces the old one once the whole feed has been processed, so
+an interrupted delta run can simply be started again. When asked, the ids that
+were in the previous snapshot but not in this feed are written out as deletions.
+'''
+
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+RECORD = struct.Struct('>QQ')
+RUN_ROWS = 200000 #rows sorted in memory before spilling to a temporary file
+
+
+def hash64(data):
+    return struct.unpack('>Q', hashlib.md5(data).digest()[:8])[0]
+
+
+class Snapshot(object):
+    '''
+    Read side of a snapshot: memory-mapped, binary-searched id hash -> row hash.
+    A missing snapshot behaves as an empty one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.idx_file = None
+        self.mapped = None
+        self.count = 0
+        if os.path.exists(path + '.idx') and os.path.getsize(path + '.idx'):
+            self.idx_file = open(path + '.idx', 'rb')
+            self.mapped = mmap.mmap(self.idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.mapped) // RECORD.size
+
+    def lookup(self, key):
+        '''
+        :return: row hash recorded for the id hash, or None
+        '''
+        lo, hi = 0, self.count
+        mapped, unpack_from, size = self.mapped, RECORD.unpack_from, RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, row = unpack_from(mapped, mid * size)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return row
+        return None
+
+    def entries(self):
+        '''
+        :return: generator of (id hash, id) in snapshot order
+        '''
+        if not self.count:
+            return
+        with open(self.path + '.ids', 'rb') as ids_file:
+            for i in xrange(self.count):
+                key, _ = RECORD.unpack_from(self.mapped, i * RECORD.size)
+                yield key, ids_file.readline().rstrip('\n')
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.idx_file.close()
+            self.mapped = None
+
+
+class SnapshotWriter(object):
+    '''
+    Builds a snapshot from unsorted rows with an external merge sort.
+    '''
+
+    def __init__(self, path, run_rows=RUN_ROWS):
+        self.path = path
+        self.run_rows = run_rows
+        self.run = []
+        self.run_files = []
+        self.added = 0
+
+    def add(self, key, row, id):
+        self.run.append((key, self.added, row, id))
+        self.added += 1
+        if len(self.run) >= self.run_rows:
+            self.spill()
+
+    def spill(self):
+        self.run.sort()
+        run_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+        for key, position, row, id in self.run:
+            run_file.write('%d %d %d %s\n' % (key, position, row, id))
+        run_file.seek(0)
+        self.run_files.append(run_file)
+        self.run = []
+
+    def read_run(self, run_file):
+        for line in run_file:
+            key, position, row, id = line.rstrip('\n').split(' ', 3)
+            yield int(key), int(position), int(row), id
+
+    def write(self, path):
+        '''
+        Merge the sorted runs into <path>.idx / <path>.ids. Repeated ids keep the row
+        added first, as runs are sorted by id hash and then by position.
+        '''
+        if self.run or not self.run_files:
+            self.spill()
+        last_key = None
+        with open(path + '.idx', 'wb') as idx_file:
+            with open(path + '.ids', 'wb') as ids_file:
+                for key, _, row, id in heapq.merge(*[self.read_run(f) for f in self.run_files]):
+                    if key == last_key:
+                        continue
+                    idx_file.write(RECORD.pack(key, row))
+                    ids_file.write(id + '\n')
+                    last_key = key
+        for run_file in self.run_files:
+            run_file.close()
+        self.run_files = []
+
+
+class DeltaFilter(object):
+    '''
+    Row filter for parse_customers: passes only rows that are new or changed since
+    the snapshot at path, and records every row for the next snapshot.
+    :param id_column: feed column of the customer id, negative ones count from the end of the row
+    '''
+
+    def __init__(self, path, run_rows=RUN_ROWS, id_column=0):
+        self.path = path
+        self.id_column = id_column
+        self.previous = Snapshot(path)
+        self.writer = SnapshotWriter(path, run_rows)
+        self.unchanged = 0
+
+    def __call__(self, line):
+        '''
+        :param line: raw feed line without its line ending
+        :return: True if the row must be synced
+        '''
+        column = self.id_column
+        try:
+            if column >= 0:
+                id = line.split(';', column + 1)[column]
+            else:
+                id = line.rsplit(';', -column)[column]
+        except IndexError: #short row, the mapping rejects it further on
+            id = ''
+        key = hash64(id)
+        row = hash64(line)
+        self.writer.add(key, row, id)
+        if self.previous.lookup(key) == row:
+            self.unchanged += 1
+            return False
+        return True
+
+    def commit(self, deleted_path=None):
+        '''
+        Replace the previous snapshot with the one of this run.
+        :param deleted_path: optional file receiving the ids missing from this run, one per line
+        :return: number of deleted ids written
+        '''
+        new_path = self.path + '.new'
+        self.writer.write(new_path)
+        deleted = 0
+        if deleted_path is not None:
+            current = Snapshot(new_path)
+            with open(deleted_path, 'wb') as deleted_file:
+                for key, id in self.previous.entries():
+                    if current.lookup(key) is None:
+                        deleted_file.write(id + '\n')
+                        deleted += 1
+            current.close()
+        self.previous.close()
+        for suffix in ('.idx', '.ids'):
+            os.rename(new_path + suffix, self.path + suffix)
+        return deleted
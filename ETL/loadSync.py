@@ -1,81 +1,590 @@
 #!/usr/bin/python
-'''preamble: 
+'''preamble:
 Take input arg
-If arg URL open & convert to file, else directly treat as file
+If arg URL stream it, else directly treat as file
 Operate on file, chunking input to avoid overloading API, transform into JSON
-Submit to Sync API endpoint 
+Submit to Sync API endpoint
+
+The input is never held in memory as a whole: lines are read one at a time
+(from the open file or from the streaming HTTP response), turned into customer
+dicts by a generator and packed into request bodies, so the first batch is posted
+while the rest of the feed is still downloading and peak memory stays flat
+regardless of input size.
+
+Parsing and serialization run on the main thread while a bounded pool of worker
+threads posts the serialized payloads, so several requests are in flight at
+once. The queue between the two stages is bounded, so at most
+MAX_PENDING_PAYLOADS payloads wait in memory at any time.
+
+Batches are sized by their serialized JSON, which is what the API limit applies
+to: each customer is encoded once and appended to the body being built, and the
+body is cut just before it would grow past CHUNK_SIZE bytes.
+
+Progress is written to a checkpoint file (see checkpoint.py) after every
+acknowledged batch. With --resume the feed is reopened at the recorded byte
+offset (a memory-mapped seek for local files, an HTTP Range request for URLs)
+and the totals carry on from the recorded values.
+
+Failed requests are retried with jittered exponential backoff (see retry.py),
+honouring Retry-After on 429/503. Batches that still fail are appended to a
+dead-letter JSONL file (see deadletter.py) and the load carries on; replay them
+later with `python loadSync.py --replay <dead_letter_file>`.
+
+All HTTP calls share the keep-alive connection pool of lambda/http_session.py,
+sized to the number of workers.
+
+The sync posts go through an adaptive limiter (see lambda/rate_limit.py): the
+number in flight starts at --workers, halves on 429/503, failed connections or
+posts slower than the latency target, and creeps back up while the API keeps
+up; a Retry-After pauses every worker at once. --rate caps the posts per second,
+and --limiter-state shares the limiter with other loadSync runs on the host.
+
+With --sync-state, customers whose serialized data is identical to what was last
+pushed for them (see lambda/sync_state.py) are left out of the payloads, and the
+index is updated as batches are acknowledged.
+
+With --delta, the feed is compared against a compact snapshot of the previous
+run (see delta.py) and only new or changed rows are parsed and sent; ids that
+disappeared since then can be written out with --deleted-out.
+
+With --processes N, a local feed is cut into newline-aligned byte ranges that a
+pool of N processes parses and serializes in parallel (see parallel.py); the
+main process only posts the payloads they return.
+
+Compressed feeds (.gz, .bz2, .xz, local or remote) are decompressed as they
+stream in (see compression.py), and request bodies are gzipped by
+lambda/http_session.py once they pass its size threshold.
+
+Feed columns are mapped to customer keys by FEED_MAPPING, or by the JSON file
+given with --mapping (see lambda/schema_mapping.py); the mapping is compiled
+once into an extractor, so a new column layout needs no code change.
+
+With --route-column or --route-map, a feed covering several app groups is
+synced in one pass: every row goes to the app group named in one of its
+columns or matched by the prefix of its customer id (see routing.py), each
+group gets request bodies of its own, posted by the same workers, and the
+totals are also reported per group. app_group_name is then optional and
+takes the rows no rule matches.
+
+--engine columnar swaps the per-row dict transform for a block-at-a-time
+columnar one (see columnar.py) that produces byte for byte identical payloads.
 
 reference: POST /api/v1/<Publisher_API_KEY>/sync_customers/ HTTP/1.1
 https://doc.agent.ai/developer/integrations/#customer-information-sync-api
 '''
 
-import sys
+import argparse
+import base64
+import collections
 import json
+import mmap
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+
 import requests
-import StringIO
-import base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')) #shared modules
+import http_session
+from sync_state import SyncState, customer_key, record_digest
+from schema_mapping import compile_mapping, load_mapping, mapping_fields, parse_mapping
+from checkpoint import Checkpoint, CheckpointMismatch
+from deadletter import DeadLetterFile, read_dead_letters
+from columnar import columnar_records
+from compression import decompress_chunks, decompressor_for
+from delta import RUN_ROWS, DeltaFilter
+from parallel import RANGES_PER_PROCESS, iter_range_lines, map_ordered, split_ranges
+from rate_limit import AdaptiveLimiter, SQLiteLimiterState, parse_retry_after
+from retry import RETRY_STATUSES, RetryPolicy, SyncError
+from routing import ColumnRouter, PrefixRouter, routed_payloads
 
 # CONSTANTS...SETTABLE OPTIONS FOR DIFFERENT CONFIGURATIONS
 API_KEY = 'change_me' #prod
 SYNC_SERVER = 'my.agent.ai' #prod
 PUBLISHER_ADMIN_USERNAME = 'admin@company.com'
 PUBLISHER_ADMIN_PASSWORD = 'changeme'
-CHUNK_SIZE = 400000 #current limit of API
-
-if len(sys.argv)<3:
-    print "Error: You must include the input file name & app group name as command-line args."
-    print "Usage: python %s <input_file> <app_group_name>" % sys.argv[0]
-    sys.exit(1)
-
-in_obj = sys.argv[1]
-if (in_obj.startswith('http')): #it's a URL to a remote file
-	r = requests.get(in_obj)
-	input_file = StringIO.StringIO(r.content)
-else: #it's a local file
-	input_file = open(sys.argv[1], 'r')
-toss = input_file.readline() #toss header
-app_group_name = sys.argv[2]
-keys = ['id','last_name']
+CHUNK_SIZE = 400000 #current limit of API, in bytes of serialized JSON
+MAX_BATCH_RECORDS = None #optional cap on customers per request
+STREAM_BLOCK_SIZE = 64 * 1024 #bytes pulled from the socket at a time for remote feeds
+WORKERS = 4 #concurrent POSTs in flight
+MAX_PENDING_PAYLOADS = 8 #serialized payloads allowed to wait for a worker
+CHECKPOINT_FILE = 'loadSync.checkpoint.json'
+DEAD_LETTER_FILE = 'loadSync.deadletter.jsonl'
+MAX_ATTEMPTS = 5 #tries per batch before it is dead-lettered
+RETRY_BUDGET = None #total retries allowed for the whole run, None for no limit
+MAX_RATE = None #sync posts per second, None for no limit
+LATENCY_TARGET = None #seconds, slower posts reduce the concurrency; None for a multiple of the fastest post
+NO_COUNTS = {'updated_count': 0, 'created_count': 0, 'error_count': 0}
+ENGINE = 'dicts' #row transform engine, 'dicts' or 'columnar' (see columnar.py)
+
+FEED_MAPPING = [ #feed column -> customer key (see lambda/schema_mapping.py), replace it with --mapping
+    ('id', 0),
+    ('last_name', 1),
+    ('properties.blacklisted', -3),
+    ('properties.member_status', -2),
+    ('properties.member_modified', -1),
+]
 url = "https://" + SYNC_SERVER + "/api/v1/" + API_KEY + "/sync_customers/"
 # The authentication header for the web service
 HTTP_BASIC_AUTHORIZATION = base64.b64encode(PUBLISHER_ADMIN_USERNAME + ':' + PUBLISHER_ADMIN_PASSWORD)
-readChunk = input_file.readlines(CHUNK_SIZE)
-updated = 0
-created = 0
-errored = 0
-total = 0
-
-while readChunk:
-    customers = [] #reset customer list
-    for line in readChunk:
+
+
+def iter_raw_lines(chunks):
+    '''
+    Split a stream of byte blocks into lines, keeping the line endings so the
+    byte offset of every line is known.
+    '''
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+
+def skip_bytes(chunks, count):
+    '''
+    Drop the first count bytes of a stream of byte blocks.
+    '''
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk[count:]
+        count = 0
+
+
+def open_feed(in_obj, offset=0):
+    '''
+    Open the input feed for line-at-a-time reading.
+    .gz, .bz2 and .xz feeds are decompressed on the fly; offsets then count
+    decompressed bytes, so resuming them decompresses and skips what was synced.
+    :param in_obj: URL of a remote file or path of a local file
+    :param offset: byte offset to start reading from
+    :return: (iterator over raw lines including line endings, close function)
+    '''
+    new_decompressor = decompressor_for(in_obj)
+    if (in_obj.startswith('http')): #it's a URL to a remote file
+        headers = {'range': 'bytes=%d-' % offset} if offset and not new_decompressor else {}
+        r = http_session.get(in_obj, stream=True, headers=headers)
+        r.raise_for_status()
+        chunks = r.iter_content(chunk_size=STREAM_BLOCK_SIZE)
+        if new_decompressor:
+            chunks = decompress_chunks(chunks, new_decompressor)
+        if offset and (new_decompressor or r.status_code != 206): #no range applied, skip what was already synced
+            chunks = skip_bytes(chunks, offset)
+        return iter_raw_lines(chunks), r.close
+    input_file = open(in_obj, 'rb') #it's a local file
+    if new_decompressor:
+        chunks = decompress_chunks(iter(lambda: input_file.read(STREAM_BLOCK_SIZE), ''), new_decompressor)
+        if offset:
+            chunks = skip_bytes(chunks, offset)
+        return iter_raw_lines(chunks), input_file.close
+    if os.fstat(input_file.fileno()).st_size == 0: #empty files cannot be mapped
+        return iter([]), input_file.close
+    mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    mapped.seek(offset)
+
+    def close():
+        mapped.close()
+        input_file.close()
+    return iter(mapped.readline, ''), close
+
+
+def parse_customers(lines, offset=0, row_filter=None, mapping=FEED_MAPPING):
+    '''
+    Turn semicolon-delimited feed lines into customer dicts, one at a time.
+    :param lines: iterator over raw (latin-1 encoded) lines, header already consumed
+    :param offset: byte offset of the first line in the feed
+    :param row_filter: optional callable given each raw line, lines it returns False for are skipped
+    :param mapping: feed mapping, column positions to customer keys
+    :return: generator of (customer dict, byte offset just past its line)
+    '''
+    extract = compile_mapping(mapping)
+    for line in lines:
+        offset += len(line)
         line = line.rstrip()
+        if not line:
+            continue
+        if row_filter is not None and not row_filter(line):
+            continue
         line = line.decode('latin-1') #spanish,italian,brazilian,mexican
-        cust_list = line.split(";")
-        cust_obj = dict(zip(keys, cust_list)) #gets first 2
-        prop_list={}
-        prop_list['properties'] = {"blacklisted":cust_list[-3],"member_status":cust_list[-2],"member_modified":cust_list[-1]}
-        cust_obj.update(prop_list)
-        customers.append(cust_obj)
-
-    payload = {"app_group": app_group_name, "customers":customers}
-    payload_json = json.dumps(payload,ensure_ascii=False).encode('latin-1') #save it back to database with proper encoding, ensure_ascii defaults to True
-    #print payload_json
-    #sys.exit(0)
+        cust_obj = extract(line.split(";"))
+        yield cust_obj, offset
+
+
+def serialize_customers(customers):
+    '''
+    Serialize parsed customers one at a time.
+    :param customers: iterator of (customer dict, end offset) as from parse_customers
+    :return: generator of (latin-1 encoded JSON record, end offset, customer id)
+    '''
+    for cust_obj, offset in customers:
+        record = json.dumps(cust_obj,ensure_ascii=False).encode('latin-1') #save it back to database with proper encoding, ensure_ascii defaults to True
+        yield record, offset, cust_obj.get('id')
+
+
+def read_records(lines, offset=0, row_filter=None, engine=ENGINE, mapping=FEED_MAPPING):
+    '''
+    Serialized customer records of the feed lines, built by the chosen transform engine.
+    Both engines produce byte for byte identical records.
+    :return: generator of (latin-1 encoded JSON record, end offset, customer id)
+    '''
+    if engine == 'columnar':
+        return columnar_records(lines, mapping, offset, row_filter)
+    return serialize_customers(parse_customers(lines, offset, row_filter, mapping))
+
+
+def build_payloads(records, app_group_name, max_bytes=CHUNK_SIZE, max_records=MAX_BATCH_RECORDS,
+                   sync_state=None):
+    '''
+    Pack serialized customers into sync_customers request bodies of at most max_bytes.
+    Every customer is serialized exactly once and appended to the body being
+    built; the body is emitted as soon as the next customer would not fit.
+    A single customer bigger than max_bytes is sent on its own.
+    :param records: iterator of (serialized customer, end offset, customer id) as from read_records
+    :param app_group_name: app group stamped on every payload
+    :param max_bytes: limit on the encoded request body
+    :param max_records: optional limit on customers per request
+    :param sync_state: optional SyncState, customers whose data is unchanged since their last push are skipped
+    :return: generator of (latin-1 encoded JSON payload, input offset just past its last customer,
+        sync state entries to record once the payload is acknowledged)
+    '''
+    head = '{"app_group": %s, "customers": [' % json.dumps(app_group_name)
+    tail = ']}'
+    empty_size = len(head) + len(tail)
+    batch = []
+    synced = []
+    size = empty_size
+    end_offset = 0
+    for record, offset, id in records:
+        if sync_state is not None:
+            key = customer_key(id, None)
+            digest = record_digest(record)
+            if key is not None and sync_state.is_unchanged(key, digest):
+                continue
+        added = len(record) + 2 if batch else len(record) #", " separator
+        if batch and (size + added > max_bytes or len(batch) == max_records):
+            yield head + ', '.join(batch) + tail, end_offset, synced
+            batch = []
+            synced = []
+            size = empty_size
+            added = len(record)
+        batch.append(record)
+        if sync_state is not None and key is not None:
+            synced.append((key, digest))
+        size += added
+        end_offset = offset
+    if batch:
+        yield head + ', '.join(batch) + tail, end_offset, synced
+
+
+def parse_range(task):
+    '''
+    Process pool worker: parse and serialize one newline-aligned byte range of a local feed.
+    :param task: (path, start, end, app_group_name, max_bytes, max_records, sync state path or None, engine, mapping)
+    :return: list of (payload, end offset, sync state entries) as yielded by build_payloads
+    '''
+    path, start, end, app_group_name, max_bytes, max_records, sync_state_path, engine, mapping = task
+    sync_state = SyncState(sync_state_path) if sync_state_path else None
+    with open(path, 'rb') as input_file:
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return list(build_payloads(read_records(iter_range_lines(mapped, start, end), start, engine=engine,
+                                                    mapping=mapping),
+                                       app_group_name, max_bytes=max_bytes, max_records=max_records,
+                                       sync_state=sync_state))
+        finally:
+            mapped.close()
+
+
+def parallel_payloads(pool, processes, path, offset, app_group_name, max_bytes, max_records, sync_state_path=None,
+                      engine=ENGINE, mapping=FEED_MAPPING):
+    '''
+    Payloads of a local feed from offset onwards, built by a process pool, in file order.
+    '''
+    tasks = ((path, start, end, app_group_name, max_bytes, max_records, sync_state_path, engine, mapping)
+             for start, end in split_ranges(path, offset))
+    for payloads in map_ordered(pool, parse_range, tasks, processes * RANGES_PER_PROCESS):
+        for payload in payloads:
+            yield payload
+
+
+class SyncTotals(object):
+    '''
+    Running sync_customers totals, safe to update from several worker threads.
+    Batches may complete in any order; the counts are plain sums. Counts added
+    with an app group are also summed per group, in groups.
+    '''
+
+    def __init__(self, counts=None):
+        self.lock = threading.Lock()
+        self.updated = 0
+        self.created = 0
+        self.errored = 0
+        self.groups = collections.defaultdict(lambda: dict(NO_COUNTS))
+        if counts:
+            self.add(counts)
+
+    def add(self, counts, app_group_name=None):
+        with self.lock:
+            self.updated += counts['updated_count']
+            self.created += counts['created_count']
+            self.errored += counts['error_count']
+            if app_group_name is not None:
+                group = self.groups[app_group_name]
+                for key in group:
+                    group[key] += counts[key]
+
+    @property
+    def total(self):
+        return self.updated + self.created + self.errored
+
+
+def post_payload(payload_json, limiter=None):
+    '''
+    Post one serialized batch to the sync API.
+    :param limiter: optional AdaptiveLimiter pacing the posts
+    :return: decoded JSON response with the updated/created/error counts
+    :raise SyncError: if the endpoint is unreachable or the response is unusable
+    '''
     headers = {
         'content-type': "application/json",
         'cache-control': "no-cache",
         'authorization': "Basic " + HTTP_BASIC_AUTHORIZATION
     }
     try:
-        response = requests.request("POST", url, data=payload_json, headers=headers)
-        print(response.text)
+        response = http_session.request("POST", url, data=payload_json, headers=headers, compress=True, limiter=limiter)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        raise SyncError("Error connecting to API endpoint " + url + ": " + str(e))
+    print(response.text)
+    if response.status_code != 200:
+        raise SyncError("Sync post failed, status: {}".format(response.status_code),
+                        retryable=response.status_code in RETRY_STATUSES or response.status_code >= 500,
+                        retry_after=parse_retry_after(response.headers.get('retry-after')))
+    try:
         counts = json.loads(response.text)
-        updated += counts['updated_count']
-        created += counts['created_count']
-        errored += counts['error_count']
-        total = updated + created + errored
-        readChunk = input_file.readlines(CHUNK_SIZE) #read in next chunk
-    except requests.exceptions.ConnectionError:
-        print("Error connecting to API endpoint " + url + ". Reconnecting...")
-print("TOTALS updated: {} created: {} errored: {} all: {}".format(updated, created, errored, total))
-input_file.close()
+        counts['updated_count'], counts['created_count'], counts['error_count']
+    except (ValueError, KeyError, TypeError):
+        raise SyncError("Unexpected sync response: " + response.text[:200])
+    return counts
+
+
+def submit_payloads(payloads, workers=WORKERS, max_pending=MAX_PENDING_PAYLOADS, checkpoint=None,
+                    retry_policy=None, dead_letter=None, sync_state=None, limiter=None):
+    '''
+    Post serialized payloads from a pool of worker threads.
+    The producer blocks once max_pending payloads are queued, which keeps
+    parsing from running ahead of the API. Batches the retry policy gives up
+    on go to the dead-letter file and count as handled. Any other worker
+    error stops the pipeline and is re-raised here once every thread has finished.
+    :param payloads: iterator of (serialized payload, input end offset, sync state entries), optionally
+        followed by the app group of the payload for per group totals
+    :param workers: number of concurrent POSTs
+    :param max_pending: payloads allowed to wait in the queue
+    :param checkpoint: optional Checkpoint acknowledged after every batch
+    :param retry_policy: RetryPolicy for failed requests, defaults to RetryPolicy()
+    :param dead_letter: DeadLetterFile for batches that keep failing, or None to abort on them
+    :param sync_state: optional SyncState recording the customers of every acknowledged batch
+    :param limiter: optional AdaptiveLimiter pacing the posts of the workers
+    :return: SyncTotals for every acknowledged batch, including those of a resumed run
+    '''
+    pending = Queue.Queue(maxsize=max_pending)
+    totals = SyncTotals(checkpoint.counts if checkpoint else None)
+    retry_policy = retry_policy or RetryPolicy()
+    errors = []
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if errors:
+                continue #drain the queue so the producer never blocks
+            seq, payload_json, end_offset, synced = item[:4]
+            try:
+                try:
+                    counts = retry_policy.call(post_payload, payload_json, limiter)
+                except SyncError as e:
+                    if dead_letter is None:
+                        raise
+                    print("Giving up on batch ending at offset {}: {}".format(end_offset, e))
+                    dead_letter.write(payload_json, end_offset, synced, e)
+                    counts = NO_COUNTS
+                else:
+                    if sync_state is not None and synced:
+                        sync_state.mark_synced(synced)
+                totals.add(counts, item[4] if len(item) > 4 else None)
+                if checkpoint:
+                    checkpoint.acknowledge(seq, end_offset, counts)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for seq, payload in enumerate(payloads):
+            if errors:
+                break
+            pending.put((seq,) + tuple(payload))
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return totals
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sync a semicolon-delimited customer feed to the sync_customers API.")
+    parser.add_argument('input_file', help="local path or http(s) URL of the feed, or a dead-letter file with --replay")
+    parser.add_argument('app_group_name', nargs='?')
+    parser.add_argument('--max-bytes', type=int, default=CHUNK_SIZE, help="limit on the serialized request body")
+    parser.add_argument('--max-records', type=int, default=MAX_BATCH_RECORDS, help="limit on customers per request")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="concurrent POSTs in flight")
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING_PAYLOADS, help="serialized payloads buffered ahead of the workers")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help="file recording the last acknowledged offset and totals")
+    parser.add_argument('--resume', action='store_true', help="continue from the offset recorded in the checkpoint file")
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help="tries per batch before it is dead-lettered")
+    parser.add_argument('--retry-budget', type=int, default=RETRY_BUDGET, help="total retries allowed for the run")
+    parser.add_argument('--rate', type=float, default=MAX_RATE, help="sync posts per second allowed")
+    parser.add_argument('--latency-target', type=float, default=LATENCY_TARGET, help="seconds above which a post counts as overload")
+    parser.add_argument('--limiter-state', help="SQLite file sharing the rate and concurrency limits with other runs on the host")
+    parser.add_argument('--dead-letter', default=DEAD_LETTER_FILE, help="JSONL file receiving batches that keep failing")
+    parser.add_argument('--replay', action='store_true', help="post the batches of the dead-letter file given as input_file")
+    parser.add_argument('--delta', metavar='SNAPSHOT', help="only send rows that changed since the run that wrote this snapshot")
+    parser.add_argument('--deleted-out', help="with --delta, file receiving the ids missing since the previous run")
+    parser.add_argument('--delta-run-rows', type=int, default=RUN_ROWS, help="with --delta, rows of the new snapshot sorted in memory at a time")
+    parser.add_argument('--engine', choices=['dicts', 'columnar'], default=ENGINE, help="row transform engine, both give identical payloads")
+    parser.add_argument('--mapping', help="JSON file mapping feed columns to customer keys, instead of FEED_MAPPING")
+    parser.add_argument('--processes', type=int, default=1, help="parse a local feed with this many processes")
+    parser.add_argument('--sync-state', help="sync state index file, customers unchanged since their last push are skipped")
+    route = parser.add_mutually_exclusive_group()
+    route.add_argument('--route-column', type=int, help="feed column holding the app group of each row, negative counts from the end")
+    route.add_argument('--route-map', help="JSON file mapping customer id prefixes to app groups")
+    args = parser.parse_args(argv[1:])
+    routed = args.route_column is not None or args.route_map is not None
+    if not args.replay and args.app_group_name is None and not routed:
+        parser.error("You must include the input file name & app group name as command-line args.")
+    if routed and (args.replay or args.processes > 1):
+        parser.error("--route-column and --route-map cannot be combined with --replay or --processes")
+    if args.replay and args.dead_letter == args.input_file:
+        parser.error("--dead-letter must name a different file when replaying " + args.input_file)
+    if not args.replay:
+        try:
+            decompressor_for(args.input_file)
+        except ValueError as e: #no decompressor installed for the feed's compression
+            parser.error(str(e))
+    if args.processes > 1 and (args.input_file.startswith('http') or decompressor_for(args.input_file)
+                               or args.delta or args.replay):
+        parser.error("--processes only applies to uncompressed local feeds and cannot be combined with --delta or --replay")
+    if args.delta_run_rows < 1:
+        parser.error("--delta-run-rows must be at least 1")
+    if args.delta and args.resume:
+        parser.error("--delta runs cannot be resumed, start them again: the snapshot is only replaced once a run completes")
+    try:
+        mapping = load_mapping(args.mapping) if args.mapping else FEED_MAPPING
+        compile_mapping(mapping)
+    except (IOError, ValueError) as e:
+        parser.error("invalid --mapping: {}".format(e))
+    if mapping_fields(mapping):
+        parser.error("--mapping sources must be column positions, the feed has no field names")
+    id_columns = [source for path, source, _ in parse_mapping(mapping) if path == (u'id',) and isinstance(source, (int, long))]
+    if args.delta and not id_columns:
+        parser.error("--delta needs the mapping to read the customer id from a feed column")
+    router = None
+    if args.route_column is not None:
+        router = ColumnRouter(args.route_column, args.app_group_name)
+    elif args.route_map is not None:
+        try:
+            router = PrefixRouter.load(args.route_map, args.app_group_name)
+        except (IOError, ValueError) as e:
+            parser.error("invalid --route-map: {}".format(e))
+    run_group = args.app_group_name
+    if router is not None: #checkpoints of routed runs only resume runs routed the same way
+        run_group = 'routed by {}, default {}'.format(router.describe(), args.app_group_name)
+
+    http_session.configure(pool_maxsize=args.workers)
+    retry_policy = RetryPolicy(max_attempts=args.max_attempts, budget=args.retry_budget)
+    limiter = AdaptiveLimiter(args.workers, rate=args.rate, latency_target=args.latency_target,
+                              state=SQLiteLimiterState(args.limiter_state) if args.limiter_state else None)
+    dead_letter = DeadLetterFile(args.dead_letter)
+    sync_state = SyncState(args.sync_state) if args.sync_state else None
+    if args.replay:
+        try:
+            totals = submit_payloads(read_dead_letters(args.input_file), workers=args.workers,
+                                     max_pending=args.max_pending, retry_policy=retry_policy,
+                                     dead_letter=dead_letter, sync_state=sync_state, limiter=limiter)
+        finally:
+            dead_letter.close()
+        print_totals(totals, dead_letter)
+        return
+
+    if args.resume:
+        try:
+            checkpoint = Checkpoint.load(args.checkpoint, args.input_file, run_group)
+        except CheckpointMismatch as e:
+            parser.error(str(e))
+    else:
+        checkpoint = Checkpoint(args.checkpoint, args.input_file, run_group)
+    offset = checkpoint.offset
+    delta = DeltaFilter(args.delta, run_rows=args.delta_run_rows, id_column=id_columns[0]) if args.delta else None
+    lines, close_feed = open_feed(args.input_file, offset)
+    pool = None
+    try:
+        if not offset:
+            offset = len(next(lines, '')) #toss header
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            payloads = parallel_payloads(pool, args.processes, args.input_file, offset, args.app_group_name,
+                                         args.max_bytes, args.max_records, args.sync_state, args.engine, mapping)
+        elif router is not None:
+            payloads = routed_payloads(read_records(router.lines(lines, offset), offset, row_filter=delta,
+                                                    engine=args.engine, mapping=mapping),
+                                       router, offset, max_bytes=args.max_bytes, max_records=args.max_records,
+                                       sync_state=sync_state)
+        else:
+            payloads = build_payloads(read_records(lines, offset, row_filter=delta, engine=args.engine, mapping=mapping),
+                                      args.app_group_name,
+                                      max_bytes=args.max_bytes, max_records=args.max_records,
+                                      sync_state=sync_state)
+        totals = submit_payloads(payloads, workers=args.workers, max_pending=args.max_pending,
+                                 checkpoint=checkpoint, retry_policy=retry_policy,
+                                 dead_letter=dead_letter, sync_state=sync_state, limiter=limiter)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        close_feed()
+        dead_letter.close()
+    print_totals(totals, dead_letter)
+    if router is not None and router.unrouted:
+        print("UNROUTED rows skipped: {}".format(router.unrouted))
+    if delta is not None:
+        deleted = delta.commit(args.deleted_out)
+        print("DELTA unchanged rows skipped: {}".format(delta.unchanged))
+        if args.deleted_out:
+            print("DELTA deleted ids: {} written to {}".format(deleted, args.deleted_out))
+
+
+def print_totals(totals, dead_letter):
+    for app_group_name, counts in sorted(totals.groups.items()):
+        if isinstance(app_group_name, unicode):
+            app_group_name = app_group_name.encode('utf-8')
+        print("TOTALS {} updated: {} created: {} errored: {}".format(app_group_name, counts['updated_count'],
+                                                                      counts['created_count'], counts['error_count']))
+    print("TOTALS updated: {} created: {} errored: {} all: {}".format(totals.updated, totals.created, totals.errored, totals.total))
+    if dead_letter.count:
+        print("DEAD-LETTERED batches: {} written to {}".format(dead_letter.count, dead_letter.path))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
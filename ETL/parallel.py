@@ -0,0 +1,63 @@
+'''
+Multi-process parsing for large local feeds.
+
+The file is cut into byte ranges of about RANGE_SIZE that start and end on line
+boundaries. A pool of worker processes memory-maps the file and turns each range
+into ready-to-send payloads, while the parent only posts them. Results come back
+in file order, so checkpoint offsets stay meaningful, and at most
+RANGES_PER_PROCESS ranges per process are in flight at once. A worker returns
+the payloads of a whole range together, so those ranges are kept small: the
+payloads held in memory come to a few times RANGE_SIZE per process. Each range
+ends with one batch that is usually smaller than the size limit.
+'''
+
+import collections
+import mmap
+import os
+
+RANGE_SIZE = 1024 * 1024 #bytes of input handed to a worker at a time, its payloads are held whole until posted
+RANGES_PER_PROCESS = 2 #ranges queued per worker process
+
+
+def split_ranges(path, start=0, range_size=RANGE_SIZE):
+    '''
+    Cut the file from start to its end into newline-aligned byte ranges.
+    :return: generator of (start, end) offsets
+    '''
+    size = os.path.getsize(path)
+    if start >= size:
+        return
+    with open(path, 'rb') as input_file:
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while start < size:
+                end = mapped.find('\n', min(start + range_size, size) - 1)
+                end = size if end == -1 else end + 1
+                yield start, end
+                start = end
+        finally:
+            mapped.close()
+
+
+def iter_range_lines(mapped, start, end):
+    '''
+    Lines of a memory-mapped file between two line-aligned offsets, line endings included.
+    '''
+    mapped.seek(start)
+    while mapped.tell() < end:
+        yield mapped.readline()
+
+
+def map_ordered(pool, func, tasks, window):
+    '''
+    Like pool.imap, but with at most window tasks submitted ahead of the consumer,
+    so results cannot pile up in memory when the consumer is slower than the pool.
+    :return: generator of results in task order
+    '''
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
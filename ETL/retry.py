@@ -0,0 +1,85 @@
+'''
+Retry policy for sync API requests.
+
+Failed requests are retried with full-jitter exponential backoff: the n-th
+retry waits a random time between 0 and min(max_delay, base_delay * 2**n)
+seconds, or at least as long as the server asked for in a Retry-After header
+on 429/503 responses. A run-wide retry budget caps the total number of retries
+so a long outage cannot keep every worker retrying forever; once a batch runs
+out of attempts or budget the caller hands it to the dead-letter file.
+'''
+
+import random
+import threading
+import time
+
+# Status codes worth retrying, anything else below 500 is the request's fault
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class SyncError(Exception):
+    '''
+    A sync API request that did not produce a usable response.
+    :param retryable: whether sending the same request again may succeed
+    :param retry_after: seconds the server asked us to wait, if any
+    '''
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        Exception.__init__(self, message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class RetryPolicy(object):
+    '''
+    Jittered exponential backoff with a per-request attempt limit and a
+    run-wide retry budget shared by every thread using the policy.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, budget=None, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def backoff(self, retry, retry_after=None):
+        '''
+        Seconds to wait before the given retry (0 for the first one).
+        '''
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def take_retry(self):
+        '''
+        Consume one retry from the run-wide budget.
+        :return: False once the budget is used up
+        '''
+        if self.budget is None:
+            return True
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call func until it returns, retrying on retryable SyncErrors.
+        :raise SyncError: the last error once attempts or budget are exhausted,
+            or straight away if it is not retryable
+        '''
+        retry = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except SyncError as e:
+                if not e.retryable or retry + 1 >= self.max_attempts or not self.take_retry():
+                    raise
+                delay = self.backoff(retry, e.retry_after)
+                print("{}. Retrying in {:.1f}s...".format(e, delay))
+                self.sleep(delay)
+                retry += 1
@@ -0,0 +1,194 @@
+'''
+Routing of feed rows to app groups, so a feed covering several app groups is
+synced in one pass instead of once per group over filtered copies.
+
+The app group of a row is read from one of its columns (ColumnRouter), or
+looked up by the prefix of its customer id in a JSON object mapping id
+prefixes to app group names (PrefixRouter, the longest matching prefix wins).
+Rows no rule matches go to the default app group, or are skipped and counted
+when there is none.
+
+routed_payloads() packs the customers of every app group into request bodies
+of their own as the rows stream past. Since rows of one group wait in its
+buffer while other groups' bodies go out, the offset given with each body is
+the feed position before which every row has been sent: a resumed run may send
+a few rows again, but never skips one.
+'''
+
+import collections
+import json
+
+from columnar import BLOCK_ROWS
+from sync_state import customer_key, record_digest
+
+MAX_PENDING_LINES = 4 * BLOCK_ROWS #lines a ColumnRouter remembers, well past the columnar engine's read-ahead
+
+
+class PrefixRouter(object):
+    '''
+    App group by customer id prefix.
+    :param prefixes: dict of id prefix to app group name
+    :param default: app group of the rows no prefix matches, None to skip them
+    '''
+
+    def __init__(self, prefixes, default=None):
+        self.prefixes = prefixes
+        self.lengths = sorted(set(len(prefix) for prefix in prefixes), reverse=True)
+        self.default = default
+        self.unrouted = 0
+
+    @classmethod
+    def load(cls, path, default=None):
+        '''
+        Read the prefix map from a JSON file, e.g. {"EU-": "europe", "US-": "americas"}.
+        :raise ValueError: if the file is not a JSON object of strings
+        '''
+        with open(path, 'r') as map_file:
+            prefixes = json.load(map_file)
+        if not isinstance(prefixes, dict) or not all(isinstance(group, basestring) and group
+                                                     for group in prefixes.values()):
+            raise ValueError("expected a JSON object mapping id prefixes to app group names")
+        return cls(prefixes, default)
+
+    def describe(self):
+        return 'id prefix'
+
+    def lines(self, lines, offset):
+        return lines
+
+    def group(self, end_offset, id):
+        '''
+        :return: app group of the row ending at end_offset with this customer id, None to skip it
+        '''
+        if id:
+            for length in self.lengths:
+                group = self.prefixes.get(id[:length])
+                if group is not None:
+                    return group
+        return self.default
+
+
+class ColumnRouter(object):
+    '''
+    App group by the value of a feed column.
+    The column is read as the lines go into the row transform (see lines()), and
+    the group of each transformed row is then found by the offset it ends at.
+    :param column: feed column position, negative ones count from the end of the row
+    :param default: app group of the rows with an empty or missing column, None to skip them
+    '''
+
+    def __init__(self, column, default=None):
+        self.column = column
+        self.default = default
+        self.unrouted = 0
+        self.pending = collections.deque()
+
+    def describe(self):
+        return 'column %d' % self.column
+
+    def lines(self, lines, offset):
+        '''
+        Pass the feed lines through, noting the app group of each.
+        :param offset: byte offset of the first line in the feed
+        '''
+        column = self.column
+        pending = self.pending
+        for line in lines:
+            offset += len(line)
+            row = line.rstrip()
+            try:
+                if column >= 0:
+                    value = row.split(';', column + 1)[column]
+                else:
+                    value = row.rsplit(';', -column)[column]
+            except IndexError:
+                value = ''
+            pending.append((offset, value.decode('latin-1') or self.default))
+            if len(pending) > MAX_PENDING_LINES: #only left by rows the transform skipped
+                pending.popleft()
+            yield line
+
+    def group(self, end_offset, id):
+        '''
+        :return: app group of the row ending at end_offset, None to skip it
+        '''
+        pending = self.pending
+        while pending:
+            offset, group = pending.popleft()
+            if offset == end_offset:
+                return group
+        raise ValueError("no routed line ends at offset %d" % end_offset)
+
+
+class GroupBatch(object):
+    '''
+    Request body being built for one app group.
+    '''
+
+    def __init__(self, app_group_name):
+        self.head = '{"app_group": %s, "customers": [' % json.dumps(app_group_name)
+        self.records = []
+        self.synced = []
+        self.size = len(self.head) + 2
+        self.start = None #feed offset before the first buffered row
+
+    def payload(self):
+        return self.head + ', '.join(self.records) + ']}'
+
+    def clear(self):
+        self.records = []
+        self.synced = []
+        self.size = len(self.head) + 2
+
+
+def sent_offset(batches, offset):
+    '''
+    Feed offset before which every row has left the buffers.
+    '''
+    return min([batch.start for batch in batches.itervalues() if batch.records] + [offset])
+
+
+def routed_payloads(records, router, offset, max_bytes, max_records=None, sync_state=None):
+    '''
+    Pack serialized customers into request bodies per app group, cut like build_payloads cuts them.
+    :param records: iterator of (serialized customer, end offset, customer id), read from router.lines()
+    :param router: PrefixRouter or ColumnRouter
+    :param offset: feed offset of the first record's line
+    :param sync_state: optional SyncState, customers whose data is unchanged since their last push are skipped
+    :return: generator of (latin-1 encoded JSON payload, feed offset before which every row was sent,
+        sync state entries to record once the payload is acknowledged, app group)
+    '''
+    batches = {}
+    for record, end_offset, id in records:
+        group = router.group(end_offset, id)
+        if group is None:
+            router.unrouted += 1
+            offset = end_offset
+            continue
+        if sync_state is not None:
+            key = customer_key(id, None)
+            digest = record_digest(record)
+            if key is not None and sync_state.is_unchanged(key, digest):
+                offset = end_offset
+                continue
+        batch = batches.get(group)
+        if batch is None:
+            batch = batches[group] = GroupBatch(group)
+        added = len(record) + 2 if batch.records else len(record) #", " separator
+        if batch.records and (batch.size + added > max_bytes or len(batch.records) == max_records):
+            payload, synced = batch.payload(), batch.synced
+            batch.clear()
+            yield payload, sent_offset(batches, offset), synced, group
+            added = len(record)
+        if not batch.records:
+            batch.start = offset
+        batch.records.append(record)
+        if sync_state is not None and key is not None:
+            batch.synced.append((key, digest))
+        batch.size += added
+        offset = end_offset
+    for group, batch in batches.items():
+        if batch.records:
+            payload, synced = batch.payload(), batch.synced
+            batch.clear()
+            yield payload, sent_offset(batches, offset), synced, group
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+'''
+Synthetic customer feeds in the loadSync.py format: a header line, then one
+semicolon-separated latin-1 row per customer with the id and last name first and
+the blacklisted, member_status and member_modified columns last. Names include
+accented characters, as in the real exports. A .gz, .bz2 path gets a compressed feed.
+Ids are the row number after --id-prefix, so feeds can exercise loadSync.py --route-map.
+
+usage: python benchmarks/feeds.py <path> <rows> [--extra-columns N] [--seed S] [--id-prefix P]
+
+examples:
+  python benchmarks/feeds.py feed.csv.gz 1000000
+  python benchmarks/feeds.py eu-feed.csv 100000 --id-prefix EU-
+'''
+
+import argparse
+import bz2
+import gzip
+import random
+import sys
+
+HEADER_COLUMNS = ['id', 'last_name']
+TAIL_COLUMNS = ['blacklisted', 'member_status', 'member_modified']
+LAST_NAMES = [u'P\xe9rez', u'Garc\xeda', u'M\xfcller', u'Rossi', u'Concei\xe7\xe3o', u'Smith', u'N\xfa\xf1ez', u"O'Brien"]
+STATUSES = ['active', 'lapsed', 'pending', 'gold']
+
+
+def open_output(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'wb')
+    return open(path, 'wb')
+
+
+def feed_rows(rows, extra_columns=1, seed=1, id_prefix=''):
+    '''
+    Generate feed lines, header included.
+    :param extra_columns: filler columns between the last name and the three property columns
+    :return: generator of latin-1 encoded lines ending with a newline
+    '''
+    rng = random.Random(seed)
+    yield ';'.join(HEADER_COLUMNS + ['extra%d' % i for i in range(extra_columns)] + TAIL_COLUMNS) + '\n'
+    for i in xrange(rows):
+        row = [u'%s%d' % (id_prefix, i), u'%s%d' % (rng.choice(LAST_NAMES), i)]
+        row.extend(u'x%d' % rng.randint(0, 999) for _ in range(extra_columns))
+        row.append(u'1' if rng.random() < 0.02 else u'0')
+        row.append(rng.choice(STATUSES).decode('ascii'))
+        row.append(u'%04d-%02d-%02d' % (rng.randint(2010, 2017), rng.randint(1, 12), rng.randint(1, 28)))
+        yield (u';'.join(row) + u'\n').encode('latin-1')
+
+
+def write_feed(path, rows, extra_columns=1, seed=1, id_prefix=''):
+    '''
+    Write a synthetic feed.
+    :return: number of bytes written (before compression)
+    '''
+    size = 0
+    output = open_output(path)
+    try:
+        for line in feed_rows(rows, extra_columns, seed, id_prefix):
+            output.write(line)
+            size += len(line)
+    finally:
+        output.close()
+    return size
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Write a synthetic loadSync.py feed.")
+    parser.add_argument('path')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--extra-columns', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--id-prefix', default='', help="prefix of the customer ids, the row number follows it")
+    args = parser.parse_args(argv[1:])
+    size = write_feed(args.path, args.rows, args.extra_columns, args.seed, args.id_prefix)
+    print("{}: {} rows, {} bytes".format(args.path, args.rows, size))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
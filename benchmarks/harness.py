@@ -0,0 +1,227 @@
+#!/usr/bin/python
+'''
+Benchmark harness for the sync scripts.
+
+Starts the mock APIs (see mock_servers.py) with the requested latency, error and
+429 behavior, runs the target in a child process (see target.py) with all of its
+HTTP calls sent to the mock, and reports:
+  throughput      feed rows per second for loadSync.py, invocations (or batched events) per second for a Lambda,
+                  contacts pulled per second for a bulk sync
+  latency         p50 / p99 of the HTTP requests, per API, as seen by the client
+  limiter wait    p50 / p99 of the time requests waited for a rate limiter before going out, per API
+  peak RSS        of the child process
+  bytes sent      request body bytes received by the mock, per API
+
+--json saves the results; --baseline compares them with saved results and exits
+with status 1 when throughput dropped, or peak RSS or bytes sent grew, by more than
+--tolerance.
+
+examples:
+  python benchmarks/harness.py --sync-latency 20 loadsync --rows 200000 -- --workers 8
+  python benchmarks/harness.py --sync-throttle 0.05 loadsync --feed big.csv.gz
+  python benchmarks/harness.py --zoho-latency 50 lambda aws-zoho --invocations 500
+  python benchmarks/harness.py --zoho-latency 50 lambda aws-zoho --invocations 500 --batch-size 10
+  python benchmarks/harness.py lambda aws-salesforce --id-prefix 0034100000 --id-length 15 --batch-size 10
+  python benchmarks/harness.py --zoho-contacts 50000 --zoho-change-rate 200 lambda aws-zoho --event-type bulk --invocations 3
+  python benchmarks/harness.py --json base.json loadsync --rows 100000
+  python benchmarks/harness.py --baseline base.json loadsync --rows 100000
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from feeds import write_feed
+from mock_servers import KINDS, MockServer, add_behavior_arguments, behaviors_from_args, zoho_contacts_from_args
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOLERANCE = 0.2 #relative change against the baseline tolerated before failing
+APP_GROUP = 'benchmark'
+
+
+def percentile(values, share):
+    '''
+    Nearest-rank percentile of a list of numbers, None for an empty list.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+def run_target(mock, workdir, target_args):
+    '''
+    Run target.py in workdir against the mock.
+    :return: stats written by the target, None if it wrote none
+    '''
+    stats_path = os.path.join(workdir, 'stats.json')
+    command = [sys.executable, os.path.join(HERE, 'target.py'), stats_path, mock.url] + target_args
+    returncode = subprocess.call(command, cwd=workdir)
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path) as stats_file:
+        stats = json.load(stats_file)
+    stats['returncode'] = returncode
+    return stats
+
+
+def summarize(stats, server_stats, units, unit_name):
+    '''
+    :param units: rows or invocations done by the target
+    :return: results dict, as saved by --json
+    '''
+    results = {
+        'target': stats['target'],
+        'returncode': stats['returncode'],
+        'elapsed': stats['elapsed'],
+        'units': units,
+        'unit': unit_name,
+        'throughput': units / stats['elapsed'] if stats['elapsed'] else None,
+        'peak_rss_mb': stats['maxrss_kb'] / 1024.0,
+        'apis': {},
+    }
+    for kind in KINDS + ('other',):
+        latencies = [seconds for call_kind, seconds, _, _ in stats['calls'] if call_kind == kind]
+        waits = [wait for call_kind, _, _, wait in stats['calls'] if call_kind == kind and wait is not None]
+        served = server_stats.get(kind, {})
+        if not latencies and not served.get('requests'):
+            continue
+        results['apis'][kind] = {
+            'requests': len(latencies),
+            'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'wait_p50_ms': percentile(waits, 0.5) * 1000 if waits else None,
+            'wait_p99_ms': percentile(waits, 0.99) * 1000 if waits else None,
+            'bytes_sent': served.get('bytes_received', 0),
+            'statuses': served.get('statuses', {}),
+            'customers': served.get('customers', 0),
+        }
+    if stats.get('invocations'):
+        results['invocation_p50_ms'] = percentile(stats['invocations'], 0.5) * 1000
+        results['invocation_p99_ms'] = percentile(stats['invocations'], 0.99) * 1000
+        results['failures'] = stats.get('failures', 0)
+    if 'contacts' in stats:
+        results['contacts_per_run'] = stats['contacts']
+    return results
+
+
+def print_results(results):
+    print("")
+    print("{:<20} {}".format('target', results['target']))
+    print("{:<20} {:.2f}".format('elapsed s', results['elapsed']))
+    print("{:<20} {:.1f}".format(results['unit'] + '/s', results['throughput'] or 0))
+    if 'invocation_p50_ms' in results:
+        print("{:<20} p50 {:.1f}  p99 {:.1f}  failures {}".format('invocation ms', results['invocation_p50_ms'],
+                                                                 results['invocation_p99_ms'], results['failures']))
+    if 'contacts_per_run' in results:
+        print("{:<20} {}".format('contacts per run', ' '.join(str(count) for count in results['contacts_per_run'])))
+    print("{:<20} {:.1f}".format('peak RSS MB', results['peak_rss_mb']))
+    for kind, api in sorted(results['apis'].items()):
+        statuses = ' '.join('{}:{}'.format(status, count) for status, count in sorted(api['statuses'].items()))
+        latency = "p50 {:.1f} ms  p99 {:.1f} ms".format(api['p50_ms'], api['p99_ms']) if api['p50_ms'] is not None else ''
+        print("{:<20} {} requests  {}  {} bytes sent  [{}]".format(kind, api['requests'], latency, api['bytes_sent'], statuses))
+        if api.get('wait_p50_ms') is not None:
+            print("{:<20} p50 {:.1f} ms  p99 {:.1f} ms".format(kind + ' limiter wait', api['wait_p50_ms'], api['wait_p99_ms']))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    :return: list of regressions against the baseline results, empty if none
+    '''
+    regressions = []
+    if baseline.get('throughput') and results['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append("throughput {:.1f} {unit}/s, baseline {:.1f}".format(
+            results['throughput'], baseline['throughput'], unit=results['unit']))
+    if baseline.get('peak_rss_mb') and results['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        regressions.append("peak RSS {:.1f} MB, baseline {:.1f}".format(results['peak_rss_mb'], baseline['peak_rss_mb']))
+    for kind, api in results['apis'].items():
+        sent = baseline.get('apis', {}).get(kind, {}).get('bytes_sent')
+        if sent and api['bytes_sent'] > sent * (1 + tolerance):
+            regressions.append("{} bytes sent {}, baseline {}".format(kind, api['bytes_sent'], sent))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark loadSync.py or a Lambda function against mock APIs.")
+    add_behavior_arguments(parser)
+    parser.add_argument('--seed', type=int, default=1, help="seed of the mock latency and failure draws")
+    parser.add_argument('--json', help="save the results to this file")
+    parser.add_argument('--baseline', help="results saved with --json to compare against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="relative regression tolerated against --baseline")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    targets = parser.add_subparsers(dest='target')
+    loadsync = targets.add_parser('loadsync', help="sync a feed with ETL/loadSync.py")
+    loadsync.add_argument('--rows', type=int, default=100000, help="rows of the generated feed")
+    loadsync.add_argument('--extra-columns', type=int, default=1, help="filler columns of the generated feed")
+    loadsync.add_argument('--compress', choices=['gz', 'bz2'], help="compress the generated feed")
+    loadsync.add_argument('--feed', help="existing feed to use instead of a generated one")
+    loadsync.add_argument('loadsync_args', nargs=argparse.REMAINDER, help="-- then more loadSync.py arguments")
+    lambda_function = targets.add_parser('lambda', help="invoke a lambda/ module's lambda_handler")
+    lambda_function.add_argument('module', help="e.g. aws-zoho, aws-salesforce, simple-aws-lambda-customer-sync")
+    lambda_function.add_argument('--invocations', type=int, default=200)
+    lambda_function.add_argument('--event-type', default='ticket_created', choices=['ticket_created', 'session', 'bulk'],
+                                 help="bulk runs bulk_sync_handler once per invocation, each pulling what changed since the last")
+    lambda_function.add_argument('--id-prefix', default='c', help="customer ids are this prefix and a number, 'missing' ones are not in the CRM")
+    lambda_function.add_argument('--batch-size', type=int, default=0, help="deliver the events to batch_handler in SQS batches of this size")
+    lambda_function.add_argument('--id-length', type=int, default=0, help="zero-pad the number so customer ids are this long, e.g. 15 for short Salesforce ids")
+    args = parser.parse_args(argv[1:])
+
+    workdir = tempfile.mkdtemp(prefix='sync-benchmark-')
+    mock = MockServer(0, behaviors_from_args(args), args.seed, zoho_contacts_from_args(args)).start()
+    try:
+        if args.target == 'loadsync':
+            feed = os.path.abspath(args.feed) if args.feed else os.path.join(
+                workdir, 'feed.csv' + ('.' + args.compress if args.compress else ''))
+            if args.feed:
+                units = None
+            else:
+                start = time.time()
+                write_feed(feed, args.rows, args.extra_columns)
+                print("generated {} rows in {:.1f} s".format(args.rows, time.time() - start))
+                units = args.rows
+            extra = [arg for arg in args.loadsync_args if arg != '--']
+            stats = run_target(mock, workdir, ['loadsync', feed, APP_GROUP] + extra)
+            unit_name = 'rows'
+        else:
+            stats = run_target(mock, workdir, ['lambda', args.module, str(args.invocations), args.event_type,
+                                               args.id_prefix, str(args.batch_size), str(args.id_length)])
+            units = args.invocations
+            unit_name = 'events' if args.batch_size else 'invocations'
+            if args.event_type == 'bulk' and stats is not None:
+                units, unit_name = sum(stats.get('contacts', [])), 'contacts'
+        server_stats = mock.stats.snapshot()
+    finally:
+        mock.stop()
+        if args.keep:
+            print("scratch directory kept: " + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if stats is None:
+        print("the target wrote no stats")
+        return 1
+    if units is None: #existing feed, count what reached the sync API
+        units = server_stats['sync']['customers']
+    results = summarize(stats, server_stats, units, unit_name)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if stats['returncode']:
+        print("target exited with status {}".format(stats['returncode']))
+        return 1
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
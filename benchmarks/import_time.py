@@ -0,0 +1,173 @@
+#!/usr/bin/python
+'''
+Import-time (cold start) benchmark of the Lambda modules.
+
+Every module is loaded in a fresh interpreter, the way a new Lambda container
+loads it, with __import__ timed, and reported like `python -X importtime` does
+on Python 3: self and cumulative microseconds of every module loaded, nested
+under the module that imported it. The totals are the median of --repeat runs.
+
+The run fails (exit status 1) when a module
+  opens a network connection while it is imported,
+  imports one of DEFERRED_MODULES at import time; they are only loaded on first use,
+  loads more modules than in the baseline,
+  or, with --baseline, takes more than --tolerance longer to import than in the
+  results saved with --json (and at least SLACK_MS more, to ride out noise).
+
+Without --baseline, the module counts of BASELINE_FILE, committed next to this
+script, are the baseline. Module counts hold on any machine, import times only on
+the one that saved them, so the times of BASELINE_FILE are never compared: refresh
+it with --json when a change loads new modules, and pass --baseline results saved
+on the same machine to compare times.
+
+examples:
+  python benchmarks/import_time.py
+  python benchmarks/import_time.py --json import-base.json
+  python benchmarks/import_time.py --baseline import-base.json aws-zoho
+  python benchmarks/import_time.py --json benchmarks/import_time_baseline.json
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(HERE, '..', 'lambda')
+BASELINE_FILE = os.path.join(HERE, 'import_time_baseline.json')
+MODULES = ['aws-zoho', 'aws-salesforce', 'simple-aws-lambda-customer-sync']
+DEFERRED_MODULES = ['requests', 'pytz', 'pprint', 'email', 'multiprocessing'] #must not be loaded by importing a Lambda
+REPEAT = 5
+TOLERANCE = 0.2 #relative import time increase tolerated against the baseline
+SLACK_MS = 5.0 #absolute increase always tolerated
+TOP = 15 #slowest imports listed per module
+
+CHILD = r'''
+import __builtin__, imp, json, os, socket, sys, time
+records = []
+children = [0.0]
+original_import = __builtin__.__import__
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    loaded = len(sys.modules)
+    children.append(0.0)
+    start = time.time()
+    module = None
+    try:
+        module = original_import(name, globals, locals, fromlist, level)
+        return module
+    finally:
+        elapsed = time.time() - start
+        nested = children.pop()
+        children[-1] += elapsed
+        if len(sys.modules) != loaded: #something was actually loaded, not just looked up
+            if module is not None and (fromlist or '.' not in name): #the module itself came back, it has the full name
+                name = module.__name__ + ('.' + ','.join(fromlist) if fromlist and not name else '')
+            records.append((len(children) - 1, name, elapsed - nested, elapsed))
+
+connections = []
+def no_network(self, address, *args):
+    connections.append(repr(address))
+    raise IOError("network I/O while importing, to %r" % (address,))
+socket.socket.connect = socket.socket.connect_ex = no_network
+
+path = sys.argv[1]
+sys.path.insert(0, os.path.dirname(path))
+__builtin__.__import__ = timed_import
+start = time.time()
+error = None
+try:
+    imp.load_source(os.path.basename(path)[:-3].replace('-', '_'), path)
+except Exception as e:
+    error = repr(e)
+total = time.time() - start
+__builtin__.__import__ = original_import
+json.dump({'total': total, 'records': records, 'connections': connections, 'error': error,
+           'modules': sorted(sys.modules)}, sys.stdout)
+'''
+
+
+def measure(module):
+    '''
+    Import the module once in a fresh interpreter.
+    :return: child results, see CHILD
+    '''
+    path = os.path.abspath(os.path.join(LAMBDA_DIR, module + '.py'))
+    output = subprocess.check_output([sys.executable, '-c', CHILD, path], cwd=LAMBDA_DIR)
+    return json.loads(output)
+
+
+def print_report(module, run, top=TOP):
+    '''
+    Print the slowest imports of a run in `-X importtime` layout, nesting shown by indentation.
+    '''
+    print("")
+    print("{}: {:.1f} ms".format(module, run['total'] * 1000))
+    print("import time: {:>9} | {:>10} | imported package".format('self [us]', 'cumulative'))
+    slowest = sorted(run['records'], key=lambda record: -record[3])[:top]
+    for depth, name, self_time, cumulative in run['records']:
+        if [depth, name, self_time, cumulative] in slowest:
+            print("import time: {:>9} | {:>10} | {}{}".format(int(self_time * 1e6), int(cumulative * 1e6), '  ' * depth, name))
+
+
+def check(module, run):
+    '''
+    :return: list of problems of a run that fail the benchmark whatever the baseline
+    '''
+    problems = []
+    if run['error']:
+        problems.append("{} failed to import: {}".format(module, run['error']))
+    for address in run['connections']:
+        problems.append("{} connects to {} at import".format(module, address))
+    for name in DEFERRED_MODULES:
+        if name in run['modules']:
+            problems.append("{} imports {} at import time".format(module, name))
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure the import time of the Lambda modules.")
+    parser.add_argument('modules', nargs='*', default=MODULES, help="lambda/ modules, all of them by default")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="fresh interpreters per module, the median counts")
+    parser.add_argument('--json', help="save the median import times to this file")
+    parser.add_argument('--baseline', help="results saved with --json to compare import times and module counts against")
+    parser.add_argument('--no-baseline', dest='count_baseline', action='store_false',
+                        help="without --baseline, skip the module counts check against " + os.path.basename(BASELINE_FILE))
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="relative regression tolerated against --baseline")
+    parser.add_argument('--top', type=int, default=TOP, help="slowest imports listed per module")
+    args = parser.parse_args(argv[1:])
+
+    results = {}
+    problems = []
+    for module in args.modules:
+        runs = sorted((measure(module) for _ in range(args.repeat)), key=lambda run: run['total'])
+        run = runs[len(runs) // 2]
+        print_report(module, run, args.top)
+        results[module] = {'import_ms': run['total'] * 1000, 'modules_loaded': len(run['records'])}
+        problems.extend(check(module, run))
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+            results_file.write('\n')
+    baseline_path = args.baseline or (BASELINE_FILE if args.count_baseline else None)
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        for module, result in sorted(results.items()):
+            loaded = baseline.get(module, {}).get('modules_loaded')
+            if loaded and result['modules_loaded'] > loaded:
+                problems.append("{} loads {} modules at import, baseline {}".format(module, result['modules_loaded'], loaded))
+            before = baseline.get(module, {}).get('import_ms') if args.baseline else None
+            if before and result['import_ms'] > max(before * (1 + args.tolerance), before + SLACK_MS):
+                problems.append("{} imports in {:.1f} ms, baseline {:.1f}".format(module, result['import_ms'], before))
+    print("")
+    for module, result in sorted(results.items()):
+        print("{:<40} {:>8.1f} ms".format(module, result['import_ms']))
+    for problem in problems:
+        print("REGRESSION " + problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+'''
+Micro-benchmark of lambda/iso_8601.py against the strptime/strftime functions it
+replaced in the Lambda modules.
+
+Checks first that both give identical results on the 24 character
+`YYYY-MM-DDTHH:MM:SS.mmmZ` format the sync API uses, then times parsing a varied
+set of timestamps, parsing the constant first_session value, and formatting.
+Exits with status 1 if the results differ or the codec is not faster.
+
+usage: python benchmarks/iso_8601_codec.py [iterations]
+'''
+
+from datetime import datetime, timedelta, tzinfo
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')) #shared modules
+import iso_8601
+
+ITERATIONS = 100000 #calls timed per case
+SAMPLES = 1000 #distinct timestamps in the varied set
+
+
+class UtcTZInfo(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return timedelta(0)
+
+UTC = UtcTZInfo()
+
+
+def legacy_parse_iso_8601_timestamp(timestamp):
+    if timestamp is None or len(timestamp) != 24 or timestamp[-1] != 'Z':
+        return None
+    return datetime.strptime(timestamp[:-1]+u'000', u'%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=UTC)
+
+
+def legacy_format_iso_8601_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
+
+
+def sample_timestamps(count, seed=1):
+    rng = random.Random(seed)
+    start = datetime(1990, 1, 1)
+    return [legacy_format_iso_8601_timestamp(start + timedelta(seconds=rng.randint(0, 40 * 365 * 86400),
+                                                               milliseconds=rng.randint(0, 999)))
+            for _ in range(count)]
+
+
+def check(timestamps):
+    '''
+    :return: list of (input, legacy result, codec result) that differ
+    '''
+    mismatches = []
+    for timestamp in timestamps + [None, u'', u'2016-01-01T00:00:00Z', u'2016-01-01T00:00:00.000+00:00']:
+        legacy = legacy_parse_iso_8601_timestamp(timestamp)
+        if legacy is None: #the codec accepts more variants, only compare what the old parser took
+            continue
+        fast = iso_8601.parse_iso_8601_timestamp(timestamp)
+        if fast != legacy or fast.utcoffset() != legacy.utcoffset():
+            mismatches.append((timestamp, legacy, fast))
+        elif iso_8601.format_iso_8601_timestamp(fast) != legacy_format_iso_8601_timestamp(legacy):
+            mismatches.append((timestamp, legacy_format_iso_8601_timestamp(legacy), iso_8601.format_iso_8601_timestamp(fast)))
+    return mismatches
+
+
+def bench(func, values, iterations):
+    '''
+    :return: seconds per call, cycling through values
+    '''
+    count = len(values)
+    loop = lambda: [func(values[i % count]) for i in xrange(iterations)]
+    return min(timeit.repeat(loop, number=1, repeat=3)) / iterations
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else ITERATIONS
+    timestamps = sample_timestamps(SAMPLES)
+    mismatches = check(timestamps)
+    for mismatch in mismatches[:10]:
+        print("MISMATCH {!r}: legacy {!r} codec {!r}".format(*mismatch))
+    if mismatches:
+        return 1
+    parsed = [legacy_parse_iso_8601_timestamp(timestamp) for timestamp in timestamps]
+    cases = [
+        ('parse varied', legacy_parse_iso_8601_timestamp, iso_8601.parse, timestamps), #the parser itself, no cache
+        ('parse first_session', legacy_parse_iso_8601_timestamp, iso_8601.parse_iso_8601_timestamp,
+         [u'2016-01-01T00:00:00.000Z']),
+        ('format varied', legacy_format_iso_8601_timestamp, iso_8601.format_iso_8601_timestamp, parsed),
+    ]
+    results = [(name, bench(legacy, values, iterations), bench(fast, values, iterations))
+               for name, legacy, fast, values in cases]
+    slower = False
+    print("{:<22} {:>12} {:>12} {:>8}".format('case', 'legacy us', 'codec us', 'speedup'))
+    for name, legacy, fast in results:
+        print("{:<22} {:>12.2f} {:>12.2f} {:>7.1f}x".format(name, legacy * 1e6, fast * 1e6, legacy / fast))
+        slower = slower or fast >= legacy
+    print("identical results on {} timestamps".format(len(timestamps)))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,393 @@
+#!/usr/bin/python
+'''
+Local mock of the HTTP APIs the sync scripts talk to, for benchmarking.
+
+One threaded keep-alive HTTP server answers, by request path:
+  sync        POST /api/v1/<key>/sync_customers          (gzip bodies accepted)
+  zoho        GET  /crm/private/json/Contacts/searchRecords, getSearchRecordsByPDC, getRecords
+  salesforce  POST /services/oauth2/token, GET /services/data/<v>/query and sobjects/Contact/<id>
+
+Every API kind has its own Behavior: added latency (with jitter), the share of
+requests answered with a 500, the share answered with a 429 carrying a
+Retry-After header, and a capacity: requests arriving while that many are
+already in flight are answered with a 429 too, like an overloaded API would.
+The server counts requests, statuses, body bytes received and customers synced
+per kind.
+
+CRM lookups of ids or emails starting with `missing` find nothing; any other id
+gets a generated contact. Zoho id lookups of emails find nothing, as emails are
+never contact ids. Like the real API, Salesforce answers with the 18-character
+form of 15-character ids.
+
+getRecords pages through a contact base of --zoho-contacts contacts (c0, c1, ...),
+always sorted by Modified Time, oldest first, and filtered by lastModifiedTime
+(inclusive). With --zoho-change-rate, contacts picked at random are modified at
+that rate while the server runs, moving them to the end of the listing.
+
+usage: python benchmarks/mock_servers.py [--port 8765] [--sync-latency 20] [--sync-throttle 0.05] ...
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import bisect
+import collections
+from datetime import datetime, timedelta
+import json
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+KINDS = ('sync', 'zoho', 'salesforce')
+MISSING_PREFIX = 'missing' #ids and emails starting with this are not found in the CRMs
+ZOHO_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+ZOHO_EPOCH = datetime(2016, 1, 1) #Modified Time of the first generated contact
+ZOHO_CONTACTS_PER_SECOND = 3 #generated contacts sharing a Modified Time
+ZOHO_MAX_PAGE = 200 #most records getRecords returns at once
+
+
+class Behavior(object):
+    '''
+    How one API kind responds.
+    :param latency: seconds added before every response
+    :param jitter: up to this many seconds more, uniformly distributed
+    :param error_rate: share of requests answered with 500
+    :param throttle_rate: share of requests answered with 429
+    :param retry_after: Retry-After seconds sent with 429s
+    :param capacity: requests served at once, more are answered with 429; None for no limit
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, capacity=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.capacity = capacity
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        '''
+        Count a request in.
+        :return: False if it is over capacity
+        '''
+        with self.lock:
+            self.in_flight += 1
+            return self.capacity is None or self.in_flight <= self.capacity
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def delay(self, rng):
+        return self.latency + (rng.random() * self.jitter if self.jitter else 0.0)
+
+    def failure(self, rng):
+        '''
+        :return: (status, headers) of a failure to answer with, or None
+        '''
+        draw = rng.random()
+        if draw < self.throttle_rate:
+            return 429, {'Retry-After': str(self.retry_after)}
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {}
+        return None
+
+
+class Stats(object):
+    '''
+    Per API kind counters, safe to update from the server threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.bytes_received = collections.Counter()
+        self.customers = collections.Counter()
+
+    def record(self, kind, status, body_bytes, customers=0):
+        with self.lock:
+            self.requests[kind] += 1
+            self.statuses[kind][status] += 1
+            self.bytes_received[kind] += body_bytes
+            self.customers[kind] += customers
+
+    def snapshot(self):
+        with self.lock:
+            return dict((kind, {
+                'requests': self.requests[kind],
+                'statuses': dict((str(status), count) for status, count in self.statuses[kind].items()),
+                'bytes_received': self.bytes_received[kind],
+                'customers': self.customers[kind],
+            }) for kind in KINDS)
+
+
+def zoho_contact(id, email=None, modified=None):
+    fields = [
+        ('CONTACTID', id),
+        ('Email', email or '%s@example.com' % id),
+        ('First Name', 'First%s' % id),
+        ('Last Name', 'Last%s' % id),
+        ('Salutation', 'Mx.'),
+        ('Title', 'Engineer'),
+        ('Modified Time', modified or ZOHO_EPOCH.strftime(ZOHO_TIME_FORMAT)),
+    ]
+    return {'no': '1', 'FL': [{'val': name, 'content': value} for name, value in fields]}
+
+
+class ZohoContacts(object):
+    '''
+    Contact base listed by getRecords, as (Modified Time, id) pairs in listing order.
+    :param count: contacts generated, ZOHO_CONTACTS_PER_SECOND to a second from ZOHO_EPOCH
+    :param change_rate: contacts modified per second while the server runs
+    '''
+
+    def __init__(self, count=0, change_rate=0.0, seed=None):
+        self.lock = threading.Lock()
+        self.listing = [((ZOHO_EPOCH + timedelta(seconds=i // ZOHO_CONTACTS_PER_SECOND)).strftime(ZOHO_TIME_FORMAT), 'c%d' % i)
+                        for i in xrange(count)]
+        self.listing.sort()
+        self.modified = dict((id, modified) for modified, id in self.listing)
+        self.change_rate = change_rate
+        self.changes = 0
+        self.started = time.time()
+        self.rng = random.Random(seed)
+
+    def touch(self, id, modified=None):
+        '''
+        Modify a contact, now unless told when.
+        '''
+        with self.lock:
+            self.move(id, modified or time.strftime(ZOHO_TIME_FORMAT))
+
+    def move(self, id, modified):
+        old = self.modified.get(id)
+        if old is not None:
+            del self.listing[bisect.bisect_left(self.listing, (old, id))]
+        self.modified[id] = modified
+        bisect.insort(self.listing, (modified, id))
+
+    def page(self, modified_since, from_index, to_index):
+        '''
+        :return: the (Modified Time, id) pairs from_index to to_index (1-based, inclusive) of the
+            contacts modified at or after modified_since
+        '''
+        with self.lock:
+            if self.change_rate and self.listing:
+                now = time.strftime(ZOHO_TIME_FORMAT)
+                while self.changes < int((time.time() - self.started) * self.change_rate):
+                    self.move(self.rng.choice(self.listing)[1], now)
+                    self.changes += 1
+            start = bisect.bisect_left(self.listing, (modified_since or '',))
+            return self.listing[start + from_index - 1:start + to_index]
+
+
+def zoho_response(row):
+    if row is None:
+        return {'response': {'nodata': {'code': '4422', 'message': 'There is no data to show'}}}
+    return {'response': {'result': {'Contacts': {'row': row}}, 'uri': '/crm/private/json/Contacts'}}
+
+
+def salesforce_id(id):
+    '''
+    18-character form of a 15-character Salesforce id: a case checksum appended.
+    '''
+    if len(id) != 15 or not id.isalnum():
+        return id
+    return id + ''.join('ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'[sum(1 << i for i, char in enumerate(id[start:start + 5]) if char.isupper())]
+                        for start in range(0, 15, 5))
+
+
+def salesforce_contact(id):
+    id = salesforce_id(id) #the same record whichever form it was asked for with
+    return {'attributes': {'type': 'Contact'}, 'Id': id, 'Email': '%s@example.com' % id,
+            'FirstName': 'First%s' % id, 'LastName': 'Last%s' % id, 'Salutation': 'Mx.', 'Title': 'Engineer'}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep-alive, like the real APIs
+    disable_nagle_algorithm = True
+    wbufsize = -1 #headers and body leave in one write, flushed after each request
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        self.handle_request(body)
+
+    def kind(self, path):
+        if '/sync_customers' in path:
+            return 'sync'
+        if path.startswith('/crm/'):
+            return 'zoho'
+        if path.startswith('/services/'):
+            return 'salesforce'
+        return None
+
+    def handle_request(self, body):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        kind = self.kind(url.path)
+        if kind is None:
+            return self.respond(None, 404, {'error': 'unknown path ' + url.path}, body)
+        behavior = self.server.behaviors[kind]
+        try:
+            if not behavior.enter():
+                return self.respond(kind, 429, {'error': 'mock overload'}, body,
+                                    headers={'Retry-After': str(behavior.retry_after)})
+            delay = behavior.delay(self.server.rng)
+            if delay:
+                time.sleep(delay)
+            failure = behavior.failure(self.server.rng)
+            if failure is not None:
+                status, headers = failure
+                return self.respond(kind, status, {'error': 'mock failure'}, body, headers=headers)
+            try:
+                status, response, customers = getattr(self, 'handle_' + kind)(url.path, query, body)
+            except (ValueError, KeyError) as e:
+                status, response, customers = 400, {'error': str(e)}, 0
+            self.respond(kind, status, response, body, customers=customers)
+        finally:
+            behavior.leave()
+
+    def handle_sync(self, path, query, body):
+        if self.headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        customers = len(json.loads(body.decode('latin-1'))['customers'])
+        return 200, {'updated_count': customers, 'created_count': 0, 'error_count': 0}, customers
+
+    def handle_zoho(self, path, query, body):
+        if path.endswith('/getSearchRecordsByPDC'):
+            id = query['searchValue']
+            return 200, zoho_response(None if id.startswith(MISSING_PREFIX) or '@' in id else zoho_contact(id)), 0
+        if path.endswith('/searchRecords'):
+            email = re.match(r'\(email:(.*)\)$', query['criteria']).group(1)
+            if email.startswith(MISSING_PREFIX) or '@' not in email:
+                return 200, zoho_response(None), 0
+            return 200, zoho_response(zoho_contact(email.split('@')[0], email)), 0
+        if path.endswith('/getRecords'):
+            from_index, to_index = int(query.get('fromIndex', 1)), int(query.get('toIndex', 20))
+            if from_index < 1 or not 0 <= to_index - from_index < ZOHO_MAX_PAGE:
+                raise ValueError("fromIndex to toIndex must span 1 to %d records" % ZOHO_MAX_PAGE)
+            rows = [zoho_contact(id, modified=modified) for modified, id in
+                    self.server.zoho_contacts.page(query.get('lastModifiedTime'), from_index, to_index)]
+            for no, row in enumerate(rows, from_index):
+                row['no'] = str(no)
+            return 200, zoho_response(rows or None), 0
+        return 404, {'error': 'unknown Zoho method ' + path}, 0
+
+    def handle_salesforce(self, path, query, body):
+        if path == '/services/oauth2/token':
+            return 200, {'access_token': 'mock-token', 'issued_at': str(int(time.time() * 1000)),
+                         'instance_url': 'http://%s:%d' % self.server.server_address, 'token_type': 'Bearer'}, 0
+        if path.endswith('/query'):
+            ids = re.findall(r"'((?:[^'\\]|\\.)*)'", query['q'])
+            records = [salesforce_contact(id) for id in ids if not id.startswith(MISSING_PREFIX)]
+            return 200, {'done': True, 'totalSize': len(records), 'records': records}, 0
+        match = re.search(r'/sobjects/Contact/([^/]+)$', path)
+        if match:
+            id = urllib.unquote(match.group(1))
+            if id.startswith(MISSING_PREFIX):
+                return 404, [{'errorCode': 'NOT_FOUND', 'message': 'The requested resource does not exist'}], 0
+            return 200, salesforce_contact(id), 0
+        return 404, {'error': 'unknown Salesforce path ' + path}, 0
+
+    def respond(self, kind, status, response, body, headers=None, customers=0):
+        if kind is not None:
+            self.server.stats.record(kind, status, len(body), customers)
+        out = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    '''
+    The mock APIs on 127.0.0.1:port (0 picks a free port).
+    :param behaviors: dict of API kind to Behavior, missing kinds answer at once without failures
+    :param zoho_contacts: ZohoContacts listed by getRecords, none by default
+    '''
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, behaviors=None, seed=None, zoho_contacts=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.behaviors = dict((kind, (behaviors or {}).get(kind) or Behavior()) for kind in KINDS)
+        self.zoho_contacts = zoho_contacts or ZohoContacts()
+        self.stats = Stats()
+        self.rng = random.Random(seed)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_behavior_arguments(parser):
+    for kind in KINDS:
+        parser.add_argument('--%s-latency' % kind, type=float, default=0.0, metavar='MS', help="added latency of %s responses" % kind)
+        parser.add_argument('--%s-jitter' % kind, type=float, default=0.0, metavar='MS', help="up to this much more latency")
+        parser.add_argument('--%s-errors' % kind, type=float, default=0.0, metavar='RATE', help="share of %s requests failing with 500" % kind)
+        parser.add_argument('--%s-throttle' % kind, type=float, default=0.0, metavar='RATE', help="share of %s requests answered with 429" % kind)
+        parser.add_argument('--%s-retry-after' % kind, type=int, default=1, metavar='S', help="Retry-After sent with 429s")
+        parser.add_argument('--%s-capacity' % kind, type=int, metavar='N', help="%s requests served at once, more get 429" % kind)
+    parser.add_argument('--zoho-contacts', type=int, default=0, metavar='N', help="contacts listed by zoho getRecords")
+    parser.add_argument('--zoho-change-rate', type=float, default=0.0, metavar='RATE', help="zoho contacts modified per second")
+
+
+def behaviors_from_args(args):
+    return dict((kind, Behavior(latency=getattr(args, kind + '_latency') / 1000.0,
+                                jitter=getattr(args, kind + '_jitter') / 1000.0,
+                                error_rate=getattr(args, kind + '_errors'),
+                                throttle_rate=getattr(args, kind + '_throttle'),
+                                retry_after=getattr(args, kind + '_retry_after'),
+                                capacity=getattr(args, kind + '_capacity')))
+                for kind in KINDS)
+
+
+def zoho_contacts_from_args(args):
+    return ZohoContacts(args.zoho_contacts, args.zoho_change_rate, args.seed)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve mock sync, Zoho and Salesforce APIs.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, help="seed of the latency and failure draws")
+    add_behavior_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    server = MockServer(args.port, behaviors_from_args(args), args.seed, zoho_contacts_from_args(args))
+    print("mock APIs on {}, Ctrl-C to stop and print the counters".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats.snapshot(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+'''
+Runs one benchmark target in this process, with every http_session request sent to
+the mock server (scheme and host replaced, path and query kept) and timed. The time
+spent waiting for a rate limiter is recorded apart from the HTTP request itself.
+harness.py starts it in a child process, so the peak RSS measured is the target's alone.
+It runs in a scratch directory: checkpoint, dead-letter, sync state, session queue
+and token cache files all end up there, as do the Lambda metrics records (metrics.jsonl).
+
+usage: python benchmarks/target.py <stats.json> <mock url> loadsync <loadSync.py args...>
+       python benchmarks/target.py <stats.json> <mock url> lambda <module> <events> <event type> [<id prefix> [<batch size> [<id length>]]]
+       (event type `bulk` invokes bulk_sync_handler <events> times instead)
+'''
+
+import imp
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import urlparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'lambda')) #shared modules
+sys.path.insert(0, os.path.join(ROOT, 'ETL'))
+import http_session
+import metrics
+from session_queue import SessionQueue
+from sync_state import SyncState
+
+
+def api_kind(path):
+    if '/sync_customers' in path:
+        return 'sync'
+    if path.startswith('/crm/'):
+        return 'zoho'
+    if path.startswith('/services/'):
+        return 'salesforce'
+    return 'other'
+
+
+def redirect_requests(mock_url, calls):
+    '''
+    Send every http_session request to the mock server, appending (API kind, seconds of the
+    HTTP request, status, seconds waited for the limiter or None without one) to calls.
+    '''
+    base = urlparse.urlsplit(mock_url)
+    send = http_session.request
+    get_session = http_session.get_session
+    sent = threading.local()
+
+    class TimedSession(object):
+        '''
+        The shared session, timing its requests in this thread.
+        '''
+        def __init__(self, session):
+            self.session = session
+
+        def request(self, method, url, **kwargs):
+            start = time.time()
+            try:
+                return self.session.request(method, url, **kwargs)
+            finally:
+                sent.seconds = time.time() - start
+
+    class TimedLimiter(object):
+        '''
+        A rate limiter, timing the wait of acquire().
+        '''
+        def __init__(self, limiter):
+            self.limiter = limiter
+            self.wait = None
+
+        def acquire(self):
+            start = time.time()
+            try:
+                return self.limiter.acquire()
+            finally:
+                self.wait = time.time() - start
+
+        def release(self, *args):
+            return self.limiter.release(*args)
+
+    def request(method, url, **kwargs):
+        parts = urlparse.urlsplit(url)
+        url = urlparse.urlunsplit((base.scheme, base.netloc, parts.path, parts.query, ''))
+        limiter = kwargs['limiter'] = TimedLimiter(kwargs['limiter']) if kwargs.get('limiter') else None
+        status = None
+        sent.seconds = None
+        start = time.time()
+        try:
+            response = send(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            seconds = sent.seconds if sent.seconds is not None else time.time() - start #never went out
+            calls.append((api_kind(parts.path), seconds, status, limiter.wait if limiter else None))
+    http_session.get_session = lambda: TimedSession(get_session())
+    http_session.request = request
+
+
+def run_loadsync(args, stats):
+    import loadSync
+    loadSync.main(['loadSync.py'] + args)
+
+
+def sqs_batches(events, batch_size):
+    '''
+    Group events into SQS batch handler events of batch_size records.
+    '''
+    for start in xrange(0, len(events), batch_size):
+        yield {u'Records': [{u'messageId': u'm%d' % i, u'eventSource': u'aws:sqs', u'body': json.dumps(event)}
+                            for i, event in enumerate(events[start:start + batch_size], start)]}
+
+
+def run_lambda(args, stats):
+    '''
+    Invoke lambda_handler once per customer id, each time with a fresh event, then flush
+    the session queue when the events were sessions. With a batch size, invoke
+    batch_handler with SQS batches of the events instead. Bulk events invoke
+    bulk_sync_handler, recording the contacts each run pulled.
+    '''
+    module_name, invocations, event_type = args[0], int(args[1]), args[2]
+    id_prefix = args[3] if len(args) > 3 else ''
+    batch_size = int(args[4]) if len(args) > 4 else 0
+    width = max(0, int(args[5]) - len(id_prefix)) if len(args) > 5 and int(args[5]) else 0 #digits of the number in the ids
+    path = os.path.join(ROOT, 'lambda', module_name if module_name.endswith('.py') else module_name + '.py')
+    module = imp.load_source(os.path.basename(path)[:-3].replace('-', '_'), path)
+    logging.getLogger().setLevel(logging.WARNING) #the handlers log every event at INFO
+    metrics.configure(stream=open('metrics.jsonl', 'a'))
+    module.sync_state = SyncState(os.path.abspath('sync-state.db'))
+    module.session_queue = SessionQueue(os.path.abspath('session-queue.db'))
+    if hasattr(module, 'token_manager'):
+        module.token_manager.cache_file = os.path.abspath('token.json')
+    durations = stats['invocations'] = []
+    failures = 0
+    if event_type == 'bulk':
+        pulled = stats['contacts'] = []
+        for i in xrange(invocations):
+            start = time.time()
+            try:
+                pulled.append(module.bulk_sync_handler({}, None)[u'contacts'])
+            except Exception as e:
+                failures += 1
+                sys.stderr.write("bulk sync {} failed: {!r}\n".format(i, e))
+            durations.append(time.time() - start)
+        stats['failures'] = failures
+        return
+    if batch_size:
+        events = [{u'event_type': event_type, u'id': u'%s%0*d' % (id_prefix, width, i), u'IDFA': None, u'timestamp': None}
+                  for i in xrange(invocations)]
+        for batch in sqs_batches(events, batch_size):
+            start = time.time()
+            failures += len(module.batch_handler(batch, None)[u'batchItemFailures'])
+            durations.append(time.time() - start)
+        stats['failures'] = failures
+        return
+    for i in xrange(invocations):
+        event = {u'event_type': event_type, u'id': u'%s%0*d' % (id_prefix, width, i), u'IDFA': None, u'timestamp': None}
+        start = time.time()
+        try:
+            module.lambda_handler(event, None)
+        except Exception as e:
+            failures += 1
+            if failures <= 3:
+                sys.stderr.write("invocation {} failed: {!r}\n".format(i, e))
+        durations.append(time.time() - start)
+    if event_type == 'session':
+        start = time.time()
+        module.flush_handler({}, None)
+        stats['flush_seconds'] = time.time() - start
+    stats['failures'] = failures
+
+
+TARGETS = {'loadsync': run_loadsync, 'lambda': run_lambda}
+
+
+def main(argv):
+    stats_path, mock_url, target, args = argv[1], argv[2], argv[3], argv[4:]
+    calls = []
+    stats = {'target': target}
+    redirect_requests(mock_url, calls)
+    start = time.time()
+    try:
+        TARGETS[target](args, stats)
+    finally:
+        stats['elapsed'] = time.time() - start
+        stats['calls'] = calls
+        stats['maxrss_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        with open(stats_path, 'w') as stats_file:
+            json.dump(stats, stats_file)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -16,40 +16,221 @@ the time it is recommended that you store the customer id or IDFA to one side (m
 data store) and then periodically process the list and update UserCare in the background.
 
 psuedo-code:
-a) call to SFDC to get token
+a) call to SFDC to get token (lazily on first use, cached in the container until shortly
+   before it expires or until SFDC answers 401)
 b) call SFDC using customer ID (passed into via event)
 c) update salutation, name, title, email
+
+For bulk syncs (for example draining the `session` backlog) `bulk_sync_handler` takes a
+list of contact ids and pulls them with SOQL `WHERE Id IN (...)` queries of
+CRM_QUERY_GROUP_SIZE ids each, following `nextRecordsUrl` pagination, then posts
+the customers to UserCare SYNC_BATCH_SIZE at a time. That is a few requests per
+thousand contacts instead of one per contact.
+
+`session` events are not synced straight away: the contact id is added to a
+deduplicating queue (see session_queue.py) and `flush_handler`, run on a schedule,
+drains the queue through the same bulk path.
+
+With SQS or Kinesis in front of the function, `batch_handler` takes a whole batch of
+events (see batch_events.py) and syncs its contacts through the bulk path too, the
+SOQL queries of a large batch running concurrently, in one `sync_customers` call.
 """
 
 import base64
-from datetime import datetime, timedelta, tzinfo
+import batch_events
+from datetime import datetime
+import fcntl
 import json
 import logging
-import pytz
-import requests
-import pprint
+import metrics
+import os
+import http_session
+from iso_8601 import UTC, format_iso_8601_timestamp
+from rate_limit import AdaptiveLimiter
+from session_queue import SessionQueue
+from schema_mapping import Const, compile_mapping, mapping_fields
+from sync_state import SyncState, customer_digest, customer_key
 import sys
+import threading
+import time
 
 # Setting for your CRM of choice (other systems might use different auth mechanisms)
 CRM_CLIENT_ID = 'FROM_YOUR_SALESFORCE_SETUP'
 CRM_CLIENT_SECRET = 'FROM_YOUR_SALESFORCE_SETUP'
 CRM_USERNAME = 'CRM_USERNAME'
 CRM_PASSWORD = 'CRM_PASSWORD'
+# Lifetime of an access token, match the session timeout of your connected app
+CRM_TOKEN_LIFETIME = 2 * 60 * 60
+# Refresh the token this many seconds before it expires
+CRM_TOKEN_REFRESH_MARGIN = 5 * 60
+# Token cache shared by processes on the same host, set to None to keep it in memory only
+CRM_TOKEN_CACHE_FILE = '/tmp/salesforce-token.json'
 
 # NOTE: SFDC requires TLS > 1.0
 def fetch_token():
     url = "https://login.salesforce.com/services/oauth2/token"
     querystring = {"grant_type":"password","client_id":CRM_CLIENT_ID,"client_secret":CRM_CLIENT_SECRET,"username":CRM_USERNAME,"password":CRM_PASSWORD}
-    return requests.post(url, data=querystring)
+    return http_session.post(url, data=querystring)
+
 
-token_response = fetch_token().json()
-token = token_response['access_token']
+class TokenManager(object):
+    """
+    Salesforce access token cached for the life of the container.
+    The token is fetched on first use, not at import, and refreshed shortly before it
+    expires or when Salesforce rejects it. Only one caller fetches at a time: others
+    wait on the lock and then use the fresh token. With a cache file, the token is
+    also shared with other processes on the host, under an exclusive file lock.
+    """
+
+    def __init__(self, fetch, lifetime=CRM_TOKEN_LIFETIME, margin=CRM_TOKEN_REFRESH_MARGIN, cache_file=CRM_TOKEN_CACHE_FILE):
+        self.fetch = fetch
+        self.lifetime = lifetime
+        self.margin = margin
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        self.rejected = None
+
+    def valid(self, expires_at):
+        return time.time() < expires_at - self.margin
+
+    def get(self):
+        """
+        Return a token that is valid for at least the refresh margin.
+        """
+        token = self.token
+        if token is not None and self.valid(self.expires_at):
+            return token
+        with self.lock:
+            if self.token is None or not self.valid(self.expires_at):
+                self.refresh()
+            return self.token
+
+    def invalidate(self, token):
+        """
+        Drop a token Salesforce has rejected, unless another caller already replaced it.
+        """
+        with self.lock:
+            if self.token == token:
+                self.rejected = token
+                self.token = None
+                self.expires_at = 0
+
+    def refresh(self):
+        if self.cache_file is None:
+            self.token, self.expires_at = self.request_token()
+            return
+        with open(self.cache_file + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            cached = self.read_cache()
+            if cached is not None and cached[0] != self.rejected and self.valid(cached[1]):
+                self.token, self.expires_at = cached
+                return
+            self.token, self.expires_at = self.request_token()
+            self.write_cache()
+
+    def request_token(self):
+        with metrics.stage('token'):
+            response = self.fetch()
+        if response.status_code != 200:
+            raise RuntimeError(u'Salesforce token request failed, status: {0}, message: {1}'.format(response.status_code, response.content))
+        token_response = response.json()
+        issued_at = float(token_response.get('issued_at', time.time() * 1000)) / 1000
+        return token_response['access_token'], issued_at + self.lifetime
+
+    def read_cache(self):
+        try:
+            with open(self.cache_file, 'r') as cache:
+                cached = json.load(cache)
+            return cached['access_token'], cached['expires_at']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def write_cache(self):
+        tmp_file = self.cache_file + '.tmp'
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600) #token is a credential
+        with os.fdopen(fd, 'w') as cache:
+            json.dump({'access_token': self.token, 'expires_at': self.expires_at}, cache)
+        os.rename(tmp_file, self.cache_file)
+
+token_manager = TokenManager(fetch_token)
+
+
+def salesforce_get(url, params=None):
+    """
+    GET a Salesforce REST resource with the cached token, refreshing it once on 401.
+    """
+    token = token_manager.get()
+    with metrics.stage('crm'):
+        response = http_session.get(url, headers={'authorization':"Bearer " + token}, params=params)
+    if response.status_code == 401:
+        token_manager.invalidate(token)
+        token = token_manager.get()
+        with metrics.stage('crm'):
+            response = http_session.get(url, headers={'authorization':"Bearer " + token}, params=params)
+    return response
+
+CRM_INSTANCE_URL = "https://na35.salesforce.com"
+# Mapping of Salesforce contact fields to UserCare customer keys and custom properties (see schema_mapping.py)
+CRM_CONTACT_MAPPING = [
+    (u'id', "Id"),
+    (u'email', "Email"),
+    (u'first_name', "FirstName"),
+    (u'last_name', "LastName"),
+    (u'first_session', Const(u'2016-01-01T00:00:00.000Z'), 'timestamp'),
+    (u'properties.Salutation', "Salutation"),
+    (u'properties.Title', "Title"),
+]
+# Contact fields requested from Salesforce, every field the mapping reads (Id always comes back)
+CRM_CONTACT_FIELDS = ",".join(field for field in mapping_fields(CRM_CONTACT_MAPPING) if field != "Id")
+# Contact ids per SOQL query, keeps the query URL well under the 16k limit
+CRM_QUERY_GROUP_SIZE = 500
+# Characters of the case checksum that makes a 15-character Salesforce id 18 characters long
+CRM_ID_SUFFIX_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ012345"
 
 def fetch_contact(id):
-    url = "https://na35.salesforce.com/services/data/v20.0/sobjects/Contact/" + id
-    querystring = {"fields":"Salutation,FirstName,LastName,Title,Email"}
-    headers = {'authorization':"Bearer " + token}
-    return requests.get(url, headers=headers, params=querystring)
+    url = CRM_INSTANCE_URL + "/services/data/v20.0/sobjects/Contact/" + id
+    querystring = {"fields":CRM_CONTACT_FIELDS}
+    return salesforce_get(url, params=querystring)
+
+def salesforce_id(id):
+    """
+    The 18-character form of a Salesforce id, the one queries return.
+    15-character ids get their case checksum appended, other values are returned as they are.
+    """
+    if id and len(id) == 15 and id.isalnum():
+        suffix = ""
+        for start in range(0, 15, 5):
+            bits = sum(1 << i for i, char in enumerate(id[start:start + 5]) if 'A' <= char <= 'Z')
+            suffix += CRM_ID_SUFFIX_CHARS[bits]
+        return id + suffix
+    if id and len(id) == 18 and id.isalnum():
+        return id[:15] + id[15:].upper() #the checksum is case-insensitive
+    return id
+
+def soql_quote(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def fetch_contacts(ids):
+    """
+    Fetch many contacts with SOQL `WHERE Id IN (...)` queries, following pagination.
+    :param ids: Salesforce contact ids
+    :return: generator of contact records, unknown ids are left out
+    """
+    for start in range(0, len(ids), CRM_QUERY_GROUP_SIZE):
+        group = ids[start:start + CRM_QUERY_GROUP_SIZE]
+        soql = "SELECT Id," + CRM_CONTACT_FIELDS + " FROM Contact WHERE Id IN (" + ",".join(soql_quote(id) for id in group) + ")"
+        response = salesforce_get(CRM_INSTANCE_URL + "/services/data/v20.0/query", params={"q": soql})
+        while True:
+            if response.status_code != 200:
+                raise RuntimeError(u'Salesforce contact query failed, status: {0}, message: {1}'.format(response.status_code, response.content))
+            result = response.json()
+            for record in result['records']:
+                yield record
+            if result.get('done', True) or not result.get('nextRecordsUrl'):
+                break
+            response = salesforce_get(CRM_INSTANCE_URL + result['nextRecordsUrl'])
 
 # Settings for the web service connection to update the UserCare user profile
 PUBLISHER_ADMIN_USERNAME = u'CHANGE_THIS_TO_ADMIN_USER_INFO'
@@ -63,11 +244,23 @@ CUSTOMER_SYNC_HOST = u'sync.usercare.com'
 CUSTOMER_SYNC_URL = u'https://' + CUSTOMER_SYNC_HOST + u'/api/v1/' + PUBLISHER_API_KEY + u'/sync_customers'
 # The authentication header for the web service
 HTTP_BASIC_AUTHORIZATION = base64.b64encode(PUBLISHER_ADMIN_USERNAME + u':' + PUBLISHER_ADMIN_PASSWORD)
+# Customers per sync post in bulk mode
+SYNC_BATCH_SIZE = 1000
+# Sync posts per second allowed from one container, None for no limit (see rate_limit.py)
+SYNC_RATE_LIMIT = None
+# Longest wait for a Retry-After of the sync API, keep it well under the function timeout
+SYNC_MAX_PAUSE = 2
 
 # Logging - reduce level to WARNING or ERROR for production
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
+session_queue = SessionQueue()
+extract_contact = compile_mapping(CRM_CONTACT_MAPPING, 'extract_contact')
+sync_state = SyncState()
+sync_limiter = AdaptiveLimiter(http_session.POOL_MAXSIZE, rate=SYNC_RATE_LIMIT, max_pause=SYNC_MAX_PAUSE)
+
+@metrics.instrumented()
 def lambda_handler(event, context):
     """
     AWS Lambda Function main entry point.
@@ -75,112 +268,184 @@ def lambda_handler(event, context):
     event_type - Event type triggering invocation, 'session' or 'ticket_created'.
     id - Externally defined customer id set via SDK or customer sync, optional.
     IDFA - Device identification supplied if id not set, optional.
-    timestamp - Customer sync timestamp, ('2016-01-01T00:00:00.000Z', UTC), optional.
+    timestamp - Customer sync timestamp, ignored: the last sync is read from the sync state (see sync_state.py).
     When the UserCare server sends these events all the fields will be present.
     However, some of the values may be set to None in the event. Your code should
     check for that an handle accordingly.
     """
 
     # Extract customer sync parameters from the event
-    # id param is CRM id
+    # id param is CRM id, in the 18-character form all entry points key customers by
     event_type = event.get('event_type','session')
-    id = event.get('id',None)
+    id = salesforce_id(event.get('id',None))
     IDFA = event.get('IDFA',None)
-    timestamp = parse_iso_8601_timestamp(event.get('timestamp',u'2016-05-29T11:45:13.381Z'))
     logger.info("got event: " + json.dumps(event))
 
-    # Ensure that the timestamp of last sync update was more than 10 seconds ago
-    customer_sync_data_timestamp = pytz.UTC.localize(datetime.now())
-    if timestamp is not None and (customer_sync_data_timestamp - timestamp).total_seconds() < 10:
+    # Skip the customer if our last sync of it was less than 10 seconds ago (see sync_state.py)
+    customer_sync_data_timestamp = datetime.now(UTC)
+    key = customer_key(id, IDFA)
+    last_synced = sync_state.last_synced(key) if key else None
+    if last_synced is not None and time.time() - last_synced[0] < 10:
         logger.info("Last update was less than 10 seconds ago")
         return
-   
-    contact = fetch_contact(id).json()
 
-    # Build customer sync data object
-    customer_sync_data = {
-        u'customers': [{
-            u'id': contact['Id'],
-            u'IDFA': IDFA,
-            u'email': contact['Email'],
-            u'first_name': contact['FirstName'],
-            u'last_name': contact['LastName'],
-            u'first_session': format_iso_8601_timestamp(parse_iso_8601_timestamp(u'2016-01-01T00:00:00.000Z')),
-            u'properties': {
-                u'Salutation': contact['Salutation'],
-                u'Title': contact['Title'],
-            },
-            u'timestamp': format_iso_8601_timestamp(customer_sync_data_timestamp)
-        }]
-    }
+    # Session events are synced in the background by flush_handler
+    if event_type == 'session':
+        session_queue.add(id, IDFA)
+        logger.info("Queued session for background sync")
+        return
 
-    # Convert the data structure to JSON to post to UserCare
-    customer_sync_data_json = json.dumps(customer_sync_data)
+    contact = fetch_contact(id).json()
 
-    # Asynchronous sync customer data request
-    response = requests.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json,
-        headers={
-            u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
-            u'Content-Type': u'application/json'
-        }
-     )
+    # Build customer sync data object
+    with metrics.stage('build'):
+        customer = build_customer(contact, IDFA, customer_sync_data_timestamp)
+    digest = customer_digest(customer)
+    if last_synced is not None and last_synced[1] == digest:
+        logger.info("Customer data unchanged since last sync")
+        return
 
-    # Raise and error back to the Lambda function caller if the sync fails
-    if response.status_code != 200:
-        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.format(response.status_code, response.content))
-
-    # Check sync customer response to make sure we have no errors
-    response_json = json.loads(response.content)
-    created_count = response_json[u'created_count']
-    updated_count = response_json[u'updated_count']
-    error_count = response_json[u'error_count']
-    # If we do raise an error back to the Lambda function caller
-    if error_count != 0:
-        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    post_customer_sync_data({u'customers': [customer]})
+    if key:
+        sync_state.mark_synced([(key, digest)])
 
     # Send response back to caller
     return None
 
 
-class UtcTZInfo(tzinfo):
+@metrics.instrumented('bulk')
+def bulk_sync_handler(event, context):
     """
-    UTC timezone used for timestamps.
+    AWS Lambda Function entry point for bulk syncs.
+    Accepts the following event parameters:
+    ids - List of Salesforce contact ids to sync.
+    Returns the summed created/updated/error counts of the sync posts.
     """
 
-    def utcoffset(self, dt):
-        return timedelta(0)
+    ids = event.get('ids') or []
+    logger.info("bulk sync of {0} contacts".format(len(ids)))
+    customer_sync_data_timestamp = datetime.now(UTC)
+    totals = {u'created_count': 0, u'updated_count': 0, u'error_count': 0}
+
+    batch = []
+    for contact in fetch_contacts(ids):
+        with metrics.stage('build'):
+            batch.append((customer_key(salesforce_id(contact['Id']), None), build_customer(contact, None, customer_sync_data_timestamp)))
+        if len(batch) == SYNC_BATCH_SIZE:
+            post_changed_customers(batch, totals)
+            batch = []
+    if batch:
+        post_changed_customers(batch, totals)
+    return totals
 
-    def tzname(self, dt):
-        return "UTC"
 
-    def dst(self, dt):
-        return timedelta(0)
+def post_changed_customers(keyed_customers, totals):
+    """
+    Post the customers whose data changed since their last sync and record the push.
+    """
+    customers, synced = sync_state.changed(keyed_customers)
+    if customers:
+        add_counts(totals, post_customer_sync_data({u'customers': customers}, raise_on_errors=False))
+        sync_state.mark_synced(synced)
 
-UTC = UtcTZInfo()
 
+@metrics.instrumented('flush')
+def flush_handler(event, context):
+    """
+    AWS Lambda Function entry point for the scheduled sync of queued `session` events.
+    Salesforce contacts are looked up by id, so customers queued with only an IDFA are dropped.
+    Returns the summed created/updated/error counts of the sync posts.
+    """
 
-def parse_iso_8601_timestamp(timestamp):
+    customer_sync_data_timestamp = datetime.now(UTC)
+    totals = {u'created_count': 0, u'updated_count': 0, u'error_count': 0}
+    for sessions in session_queue.drain(SYNC_BATCH_SIZE):
+        IDFAs = dict((salesforce_id(id), IDFA) for id, IDFA in sessions if id) #keyed like the ids queries return
+        contacts = list(fetch_contacts(list(IDFAs)))
+        with metrics.stage('build'):
+            found = [(customer_key(salesforce_id(contact['Id']), None), build_customer(contact, IDFAs.get(salesforce_id(contact['Id'])), customer_sync_data_timestamp))
+                     for contact in contacts]
+        post_changed_customers(found, totals)
+    logger.info("flushed sessions: " + json.dumps(totals))
+    return totals
+
+
+@metrics.instrumented('batch')
+def batch_handler(event, context):
     """
-    Parse ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC timestamp in ISO 8601 format
-    :return: UTC datetime timestamp
+    AWS Lambda Function entry point for events delivered in batches by SQS or Kinesis.
+    Accepts the `Records` of the batch, each carrying a lambda_handler event. All events,
+    `session` ones included, are synced straight away; customers with only an IDFA are dropped.
+    Returns the records to deliver again as `batchItemFailures`.
     """
 
-    if timestamp is None or len(timestamp) != 24 or timestamp[-1] != 'Z':
-        return None
-    return datetime.strptime(timestamp[:-1]+u'000', u'%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=UTC)
+    customer_sync_data_timestamp = datetime.now(UTC)
+    def lookup(customers):
+        # Ids come in the 18-character form queries return, see normalize_id below
+        IDFAs = dict((id, IDFA) for _, id, IDFA in customers if id)
+        ids = list(IDFAs)
+        groups = [ids[start:start + CRM_QUERY_GROUP_SIZE] for start in range(0, len(ids), CRM_QUERY_GROUP_SIZE)]
+        results = batch_events.fetch_concurrently(lambda group: list(fetch_contacts(group)), groups)
+        for group, (contacts, error) in zip(groups, results):
+            contacts = dict((salesforce_id(contact['Id']), contact) for contact in contacts or [])
+            for id in group:
+                contact = contacts.get(id)
+                yield customer_key(id, None), build_customer(contact, IDFAs[id], customer_sync_data_timestamp) if contact else None, error
+    post = lambda customer_sync_data: post_customer_sync_data(customer_sync_data, raise_on_errors=False)
+    return batch_events.sync_batch(event, lookup, post, sync_state, logger, normalize_id=salesforce_id)
 
 
-def format_iso_8601_timestamp(timestamp):
+def add_counts(totals, counts):
+    for key in totals:
+        totals[key] += counts[key]
+
+
+def build_customer(contact, IDFA, customer_sync_data_timestamp):
     """
-    Format datetime ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC datetime timestamp
-    :return: UTC timestamp in ISO 8601 format
+    Map a Salesforce contact record to a UserCare customer using CRM_CONTACT_MAPPING.
     """
+    customer = extract_contact(contact)
+    customer[u'IDFA'] = IDFA
+    customer[u'timestamp'] = format_iso_8601_timestamp(customer_sync_data_timestamp)
+    return customer
+
+
+def post_customer_sync_data(customer_sync_data, raise_on_errors=True):
+    """
+    Post customer sync data to UserCare.
+    :param raise_on_errors: raise if the response reports errors for some customers
+    :return: the created/updated/error counts of the response
+    """
+
+    # Convert the data structure to JSON to post to UserCare
+    with metrics.stage('serialize'):
+        customer_sync_data_json = json.dumps(customer_sync_data)
+    metrics.add('customers', len(customer_sync_data[u'customers']))
+    metrics.add('payload_bytes', len(customer_sync_data_json), 'Bytes')
+
+    # Asynchronous sync customer data request, gzipped if large (see http_session.py) and paced by sync_limiter
+    with metrics.stage('post'):
+        response = http_session.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json, compress=True, limiter=sync_limiter,
+            headers={
+                u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
+                u'Content-Type': u'application/json'
+            }
+         )
+
+    # Raise and error back to the Lambda function caller if the sync fails
+    if response.status_code != 200:
+        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.format(response.status_code, response.content))
+
+    # Check sync customer response to make sure we have no errors
+    response_json = json.loads(response.content)
+    created_count = response_json[u'created_count']
+    updated_count = response_json[u'updated_count']
+    error_count = response_json[u'error_count']
+    # If we do raise an error back to the Lambda function caller
+    if error_count != 0 and raise_on_errors:
+        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    return response_json
 
-    if timestamp is None:
-        return None
-    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
 
 if __name__ == '__main__':
     """
@@ -189,7 +454,20 @@ if __name__ == '__main__':
     Examples:
     `> python aws-salesforce.py ticket_created -id 00341000003EXY5`
     `> python aws-salesforce.py session -idfa AEBE52E7-03EE-455A-B3C4-E57283966239`
+    `> python aws-salesforce.py bulk contact_ids.txt` (one contact id per line)
+    `> python aws-salesforce.py flush`
     """
+    logging.basicConfig(level=logging.INFO)
+
+    if sys.argv[1] == 'flush':
+        print(flush_handler({}, None))
+        sys.exit(0)
+
+    if sys.argv[1] == 'bulk':
+        with open(sys.argv[2]) as ids_file:
+            ids = [line.strip() for line in ids_file if line.strip()]
+        print(bulk_sync_handler({u'ids': ids}, None))
+        sys.exit(0)
 
     # Parse command line arguments
     event_type = unicode(sys.argv[1])
@@ -199,12 +477,10 @@ if __name__ == '__main__':
         id = unicode(sys.argv[3])
     elif sys.argv[2] == '-idfa':
         IDFA = unicode(sys.argv[3])
-        timestamp = unicode(sys.argv[4]) if len(sys.argv) == 5 else None
 
     # Invoke AWS Lambda Function handler
     lambda_handler({
         u'event_type': event_type,
         u'id': id,
-        u'IDFA': IDFA,
-        u'timestamp': timestamp
+        u'IDFA': IDFA
     }, None)
\ No newline at end of file
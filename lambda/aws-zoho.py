@@ -14,15 +14,42 @@ complete before the agent opens the ticket, which could be a matter of a few sec
 event types are called whenever the user creates a new session. As this happens all
 the time it is recommended that you store the customer id or IDFA to one side (maybe in a DynamoDB
 data store) and then periodically process the list and update UserCare in the background.
+
+To keep `ticket_created` fast the lookup by CRM id and the lookup by email run at the
+same time and the first hit wins. Hits and misses are cached in the container for a
+few minutes (see ttl_cache.py), so repeat tickets from the same customer skip Zoho.
+
+`session` events are not synced straight away: the customer is added to a deduplicating
+queue (see session_queue.py) and `flush_handler`, run on a schedule, syncs everything
+queued in a few large `sync_customers` calls.
+
+With SQS or Kinesis in front of the function, `batch_handler` takes a whole batch of
+events (see batch_events.py): each customer in it is looked up once, the lookups run
+concurrently and the changed customers go out in one `sync_customers` call.
+
+To sync the whole contact base, `bulk_sync_handler`, run on a schedule, pages through
+Zoho Contacts with `getRecords`, least recently modified first, and posts the contacts
+SYNC_BATCH_SIZE at a time. It keeps a high-water mark of the latest `Modified Time`
+pushed (see sync_state.py), so every run pulls only the contacts changed since the
+last one: a few requests per thousand contacts instead of one call per contact.
 """
 import base64
-from datetime import datetime, timedelta, tzinfo
+import batch_events
+from datetime import datetime, timedelta
 import json
 import logging
-import pytz
-import requests
-import pprint
+import metrics
+import http_session
+from iso_8601 import UTC, format_iso_8601_timestamp
+import Queue
+from rate_limit import AdaptiveLimiter
+from session_queue import SessionQueue
+from schema_mapping import Const, compile_mapping
+from sync_state import SyncState, customer_digest, customer_key
 import sys
+import time
+import threading
+from ttl_cache import MISSING, TTLCache
 
 # Settings for the web service connection to update the UserCare user profile
 PUBLISHER_ADMIN_USERNAME = u'CHANGE_THIS_TO_ADMIN_USER_INFO'
@@ -30,6 +57,29 @@ PUBLISHER_ADMIN_PASSWORD = u'CHANGE_THIS_TO_ADMIN_USER_PASSWORD'
 PUBLISHER_API_KEY = u'CHANGE_THIS_TO_YOUR_API_KEY'
 # Setting for your CRM of choice (other systems might use different auth mechanisms)
 CRM_KEY = u'CHANGE_THIS_TO_ZOHO_CRM_API_KEY'
+# How long Zoho lookups stay cached in the container, in seconds
+CRM_CACHE_HIT_TTL = 5 * 60
+CRM_CACHE_MISS_TTL = 60
+# Number of customers kept in the lookup cache
+CRM_CACHE_SIZE = 1024
+# Contacts per getRecords page in bulk mode, 200 is the most Zoho returns at once
+CRM_PAGE_SIZE = 200
+# Seconds read again below the latest Modified Time pulled, as several contacts can share a second
+CRM_MODIFIED_OVERLAP = 1
+# Format of Zoho's `Modified Time`, in the time zone of the Zoho user owning CRM_KEY
+CRM_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Name of the bulk mode high-water mark in the sync state
+CRM_HIGH_WATER_MARK = u'zoho:Contacts:Modified Time'
+# Mapping of Zoho contact fields to UserCare customer keys and custom properties (see schema_mapping.py)
+ZOHO_CONTACT_MAPPING = [
+    (u'id', "CONTACTID"),
+    (u'email', "Email"),
+    (u'first_name', "First Name"),
+    (u'last_name', "Last Name"),
+    (u'first_session', Const(u'2016-01-01T00:00:00.000Z'), 'timestamp'),
+    (u'properties.Salutation', "Salutation"),
+    (u'properties.Title', "Title"),
+]
 
 # Constants
 # The UserCare host for the web service
@@ -38,11 +88,26 @@ CUSTOMER_SYNC_HOST = u'sync.usercare.com'
 CUSTOMER_SYNC_URL = u'https://' + CUSTOMER_SYNC_HOST + u'/api/v1/' + PUBLISHER_API_KEY + u'/sync_customers'
 # The authentication header for the web service
 HTTP_BASIC_AUTHORIZATION = base64.b64encode(PUBLISHER_ADMIN_USERNAME + u':' + PUBLISHER_ADMIN_PASSWORD)
+# Customers per sync post when flushing queued sessions or in bulk mode
+SYNC_BATCH_SIZE = 1000
+# Time left in the invocation at which bulk mode stops paging, in milliseconds; the next run carries on
+BULK_TIME_MARGIN = 30 * 1000
+# Sync posts per second allowed from one container, None for no limit (see rate_limit.py)
+SYNC_RATE_LIMIT = None
+# Longest wait for a Retry-After of the sync API, keep it well under the function timeout
+SYNC_MAX_PAUSE = 2
 
 # Logging - reduce level to WARNING or ERROR for production
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+zoho_cache = TTLCache(maxsize=CRM_CACHE_SIZE, ttl=CRM_CACHE_HIT_TTL)
+session_queue = SessionQueue()
+extract_contact = compile_mapping(ZOHO_CONTACT_MAPPING, 'extract_contact')
+sync_state = SyncState()
+sync_limiter = AdaptiveLimiter(http_session.POOL_MAXSIZE, rate=SYNC_RATE_LIMIT, max_pause=SYNC_MAX_PAUSE)
 
+@metrics.instrumented()
 def lambda_handler(event, context):
     """
     AWS Lambda Function main entry point.
@@ -50,7 +115,7 @@ def lambda_handler(event, context):
     event_type - Event type triggering invocation, 'session' or 'ticket_created'.
     id - Externally defined customer id set via SDK or customer sync, optional.
     IDFA - Device identification supplied if id not set, optional.
-    timestamp - Customer sync timestamp, ('2016-01-01T00:00:00.000Z', UTC), optional.
+    timestamp - Customer sync timestamp, ignored: the last sync is read from the sync state (see sync_state.py).
     When the UserCare server sends these events all the fields will be present.
     However, some of the values may be set to None in the event. Your code should
     check for that an handle accordingly.
@@ -61,137 +126,359 @@ def lambda_handler(event, context):
     event_type = event.get('event_type','session')
     id = event.get('id',None)
     IDFA = event.get('IDFA',None)
-    timestamp = parse_iso_8601_timestamp(event.get('timestamp',u'2016-05-29T11:45:13.381Z'))
 
     logger.info("got event: " + json.dumps(event))
 
-    # Ensure that the timestamp of last sync update was more than 10 seconds ago
-    customer_sync_data_timestamp = pytz.UTC.localize(datetime.now())
-    if timestamp is not None and (customer_sync_data_timestamp - timestamp).total_seconds() < 10:
-        logger.info("Last update was less than 10 seconds ago")
+    # Session events are synced in the background by flush_handler
+    if event_type == 'session':
+        if not id: #Zoho contacts are looked up by id or email, an IDFA alone finds nothing
+            logger.info("No id or email to look the customer up by, session dropped")
+            metrics.add('dropped_sessions', 1)
+            return
+        session_queue.add(id, IDFA)
+        logger.info("Queued session for background sync")
         return
 
-    fields = search_zoho_id(id)
-    if fields is None:
-        email = id
-        fields = search_zoho_email(email)
+    with metrics.stage('crm'):
+        record = search_zoho(id)
+    if record is None:
+        logger.info("No Zoho contact found for id or email")
+        return
 
     # Build customer sync data object
-    customer_sync_data = {
-        u'customers': [{
-            u'id': content_of_val(fields, "CONTACTID"),
-            u'IDFA': IDFA,
-            u'email': content_of_val(fields, "Email"),
-            u'first_name': content_of_val(fields, "First Name"),
-            u'last_name': content_of_val(fields, "Last Name"),
-            u'first_session': format_iso_8601_timestamp(parse_iso_8601_timestamp(u'2016-01-01T00:00:00.000Z')),
-            u'properties': {
-                u'Salutation': content_of_val(fields, "Salutation"),
-                u'Title': content_of_val(fields, "Title"),
-            },
-            u'timestamp': format_iso_8601_timestamp(customer_sync_data_timestamp)
-        }]
-    }
-
-    # Convert the data structure to JSON to post to UserCare
-    customer_sync_data_json = json.dumps(customer_sync_data)
-
-    # Asynchronous sync customer data request
-    response = requests.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json,
-                             headers={
-                                 u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
-                                 u'Content-Type': u'application/json'
-                             })
+    customer_sync_data_timestamp = datetime.now(UTC)
+    with metrics.stage('build'):
+        customer = build_customer(record, IDFA, customer_sync_data_timestamp)
+
+    # Skip the customer if our last sync of it was less than 10 seconds ago (see sync_state.py)
+    key = contact_key(customer)
+    last_synced = sync_state.last_synced(key) if key else None
+    if last_synced is not None and time.time() - last_synced[0] < 10:
+        logger.info("Last update was less than 10 seconds ago")
+        return
+    digest = customer_digest(customer)
+    if last_synced is not None and last_synced[1] == digest:
+        logger.info("Customer data unchanged since last sync")
+        return
 
-    # Raise and error back to the Lambda function caller if the sync fails
-    if response.status_code != 200:
-        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.format(response.status_code, response.content))
-
-    # Check sync customer response to make sure we have no errors
-    response_json = json.loads(response.content)
-    created_count = response_json[u'created_count']
-    updated_count = response_json[u'updated_count']
-    error_count = response_json[u'error_count']
-    # If we do raise an error back to the Lambda function caller
-    if error_count != 0:
-        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    post_customer_sync_data({u'customers': [customer]})
+    if key:
+        sync_state.mark_synced([(key, digest)])
 
     # Send response back to caller
     return None
 
 
-def content_of_val(list, arg):
-    for value in list:
-        if value['val'] == arg:
-            return (value['content'])
-# no need to return None on no match, Python handles that
+@metrics.instrumented('flush')
+def flush_handler(event, context):
+    """
+    AWS Lambda Function entry point for the scheduled sync of queued `session` events.
+    Zoho contacts are looked up by id or email, so lambda_handler does not queue customers with
+    only an IDFA; any left in the queue by earlier versions are logged and dropped.
+    Returns the summed created/updated/error counts of the sync posts.
+    """
 
-def search_zoho_email(email):
-    zhContact = requests.get('https://crm.zoho.com/crm/private/json/Contacts/searchRecords?authtoken=' + CRM_KEY + '&scope=crmapi&criteria=(email:' + email + ')')
-    data = zhContact.json()
+    customer_sync_data_timestamp = datetime.now(UTC)
+    totals = {u'created_count': 0, u'updated_count': 0, u'error_count': 0}
+    dropped = 0
+    for sessions in session_queue.drain(SYNC_BATCH_SIZE):
+        dropped += sum(1 for id, _ in sessions if not id)
+        sessions = [(id, IDFA) for id, IDFA in sessions if id]
+        with metrics.stage('crm'):
+            results = batch_events.fetch_concurrently(search_zoho, [id for id, _ in sessions])
+        found = {} #queued by id and by email, a contact is still synced once
+        for (id, IDFA), (record, error) in zip(sessions, results):
+            if error is not None: #keeps the batch queued for the next flush
+                raise error
+            if record is not None:
+                with metrics.stage('build'):
+                    customer = build_customer(record, IDFA, customer_sync_data_timestamp)
+                found[contact_key(customer)] = customer
+        customers, synced = sync_state.changed(found.items())
+        if customers:
+            add_counts(totals, post_customer_sync_data({u'customers': customers}, raise_on_errors=False))
+            sync_state.mark_synced(synced)
+    if dropped:
+        logger.warning("dropped {0} queued sessions without an id or email".format(dropped))
+        metrics.add('dropped_sessions', dropped)
+    logger.info("flushed sessions: " + json.dumps(totals))
+    return totals
+
+
+@metrics.instrumented('batch')
+def batch_handler(event, context):
+    """
+    AWS Lambda Function entry point for events delivered in batches by SQS or Kinesis.
+    Accepts the `Records` of the batch, each carrying a lambda_handler event. All events,
+    `session` ones included, are synced straight away; customers with only an IDFA are dropped.
+    Returns the records to deliver again as `batchItemFailures`.
+    """
 
-    # useful for object format & debugging
-    #pprint.pprint(data)
+    customer_sync_data_timestamp = datetime.now(UTC)
+    def lookup(customers):
+        customers = [(key, id, IDFA) for key, id, IDFA in customers if id]
+        results = batch_events.fetch_concurrently(search_zoho, [id for _, id, _ in customers])
+        for (key, id, IDFA), (record, error) in zip(customers, results):
+            yield key, build_customer(record, IDFA, customer_sync_data_timestamp) if record is not None else None, error
+    post = lambda customer_sync_data: post_customer_sync_data(customer_sync_data, raise_on_errors=False)
+    return batch_events.sync_batch(event, lookup, post, sync_state, logger, record_key=contact_key)
 
-    try:
-        return data['response']['result']['Contacts']['row']['FL']
-    except KeyError:
-        logger.info("miss on email")
-        return None
 
-def search_zoho_id(id):
-    zhContact = requests.get('https://crm.zoho.com/crm/private/json/Contacts/getSearchRecordsByPDC?authtoken='+ CRM_KEY + '&scope=crmapi&searchColumn=contactid&searchValue=' + id)
-    data = zhContact.json()
+@metrics.instrumented('bulk')
+def bulk_sync_handler(event, context):
+    """
+    AWS Lambda Function entry point for incremental syncs of all Zoho contacts, run on a schedule.
+    Accepts the following event parameters:
+    full - Pull every contact instead of those modified since the last run, optional.
+    The high-water mark moves on after every sync post, so a run that fails or times out
+    carries on from the last post; a run getting close to the function timeout stops by itself.
+    Returns the summed created/updated/error counts of the sync posts, the number of
+    `contacts` pulled, the new `high_water_mark` and whether the pull is `complete`.
+    """
 
-    # useful for object format & debugging
-    #pprint.pprint(data)
+    modified_since = None if event.get('full') else sync_state.high_water_mark(CRM_HIGH_WATER_MARK)
+    logger.info("bulk sync of Zoho contacts modified since {0}".format(modified_since or 'ever'))
+    customer_sync_data_timestamp = datetime.now(UTC)
+    totals = {u'created_count': 0, u'updated_count': 0, u'error_count': 0}
+    mark = modified_since
+    contacts = 0
+    complete = True
+
+    batch = []
+    for records, page_mark in changed_zoho_contacts(modified_since):
+        with metrics.stage('build'):
+            customers = [build_customer(record, None, customer_sync_data_timestamp) for record in records]
+        batch.extend((contact_key(customer), customer) for customer in customers)
+        contacts += len(records)
+        mark = page_mark
+        if len(batch) > SYNC_BATCH_SIZE - CRM_PAGE_SIZE: #whole pages per post, so the mark covers the post
+            post_changed_customers(batch, totals)
+            sync_state.set_high_water_mark(CRM_HIGH_WATER_MARK, mark)
+            batch = []
+        if context is not None and context.get_remaining_time_in_millis() < BULK_TIME_MARGIN:
+            complete = False
+            break
+    if batch:
+        post_changed_customers(batch, totals)
+    if mark is not None:
+        sync_state.set_high_water_mark(CRM_HIGH_WATER_MARK, mark)
+    metrics.add('crm_records', contacts)
+
+    totals.update({u'contacts': contacts, u'high_water_mark': mark, u'complete': complete})
+    logger.info("bulk sync: " + json.dumps(totals))
+    return totals
+
+
+def post_changed_customers(keyed_customers, totals):
+    """
+    Post the customers whose data changed since their last sync and record the push.
+    """
+    customers, synced = sync_state.changed(keyed_customers)
+    if customers:
+        add_counts(totals, post_customer_sync_data({u'customers': customers}, raise_on_errors=False))
+        sync_state.mark_synced(synced)
 
-    try:
-        return data['response']['result']['Contacts']['row']['FL']
-    except KeyError:
-        logger.info("miss on id")
-        return None
 
-class UtcTZInfo(tzinfo):
+def add_counts(totals, counts):
+    for key in totals:
+        totals[key] += counts[key]
+
+
+def post_customer_sync_data(customer_sync_data, raise_on_errors=True):
     """
-    UTC timezone used for timestamps.
+    Post customer sync data to UserCare.
+    :param raise_on_errors: raise if the response reports errors for some customers
+    :return: the created/updated/error counts of the response
     """
 
-    def utcoffset(self, dt):
-        return timedelta(0)
+    # Convert the data structure to JSON to post to UserCare
+    with metrics.stage('serialize'):
+        customer_sync_data_json = json.dumps(customer_sync_data)
+    metrics.add('customers', len(customer_sync_data[u'customers']))
+    metrics.add('payload_bytes', len(customer_sync_data_json), 'Bytes')
+
+    # Asynchronous sync customer data request, gzipped if large (see http_session.py) and paced by sync_limiter
+    with metrics.stage('post'):
+        response = http_session.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json, compress=True, limiter=sync_limiter,
+                                 headers={
+                                     u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
+                                     u'Content-Type': u'application/json'
+                                 })
 
-    def tzname(self, dt):
-        return "UTC"
+    # Raise and error back to the Lambda function caller if the sync fails
+    if response.status_code != 200:
+        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.format(response.status_code, response.content))
 
-    def dst(self, dt):
-        return timedelta(0)
+    # Check sync customer response to make sure we have no errors
+    response_json = json.loads(response.content)
+    created_count = response_json[u'created_count']
+    updated_count = response_json[u'updated_count']
+    error_count = response_json[u'error_count']
+    # If we do raise an error back to the Lambda function caller
+    if error_count != 0 and raise_on_errors:
+        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    return response_json
 
-UTC = UtcTZInfo()
 
+def build_customer(record, IDFA, customer_sync_data_timestamp):
+    """
+    Map an indexed Zoho contact to a UserCare customer using ZOHO_CONTACT_MAPPING.
+    Fields missing from the record map to None.
+    :param record: Zoho field name to content dict, as from zoho_records
+    """
+    customer = extract_contact(record)
+    customer[u'IDFA'] = IDFA
+    customer[u'timestamp'] = format_iso_8601_timestamp(customer_sync_data_timestamp)
+    return customer
 
-def parse_iso_8601_timestamp(timestamp):
+def contact_key(customer):
     """
-    Parse ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC timestamp in ISO 8601 format
-    :return: UTC datetime timestamp
+    Key of a built customer in the sync state, from its Zoho CONTACTID whatever id or email
+    the event named the contact by, so that every entry point keys a contact the same way.
     """
+    return customer_key(customer[u'id'], customer[u'IDFA'])
 
-    if timestamp is None or len(timestamp) != 24 or timestamp[-1] != 'Z':
-        return None
-    return datetime.strptime(timestamp[:-1]+u'000', u'%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=UTC)
+def index_fields(fields):
+    """
+    Index the `FL` list of one Zoho row by field name, so every lookup is a dict access.
+    A row holding a single field comes back from Zoho as a dict rather than a list.
+    """
+    if isinstance(fields, dict):
+        fields = [fields]
+    return dict((field['val'], field.get('content')) for field in fields)
 
+def zoho_records(data):
+    """
+    Extract the contacts of a Zoho Contacts response, whether `row` is a single row or a list.
+    :return: list of field name to content dicts, empty if the response has no rows
+    """
+    try:
+        rows = data['response']['result']['Contacts']['row']
+    except (KeyError, TypeError):
+        return []
+    if isinstance(rows, dict):
+        rows = [rows]
+    return [index_fields(row['FL']) for row in rows]
+
+def search_zoho(id):
+    """
+    Look a contact up by CRM id and by email at the same time, the id param can be either.
+    :param id: Zoho contact id or email address
+    :return: the first matching contact, indexed by field name, or None if neither lookup hits
+    """
+    record = zoho_cache.get(id)
+    if record is not MISSING:
+        return record
+
+    results = Queue.Queue()
+    def search(lookup):
+        try:
+            results.put((lookup(id), None))
+        except Exception as e:
+            results.put((None, e))
+    for lookup in (search_zoho_id, search_zoho_email):
+        thread = threading.Thread(target=search, args=(lookup,))
+        thread.daemon = True
+        thread.start()
+
+    error = None
+    for _ in range(2):
+        record, e = results.get()
+        if record is not None:
+            zoho_cache.put(id, record)
+            return record
+        error = error or e
+    if error is not None: #don't cache a miss we are not sure about
+        raise error
+    zoho_cache.put(id, None, ttl=CRM_CACHE_MISS_TTL)
+    return None
 
-def format_iso_8601_timestamp(timestamp):
+def fetch_zoho_page(from_index, modified_since=None, page_size=CRM_PAGE_SIZE):
     """
-    Format datetime ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC datetime timestamp
-    :return: UTC timestamp in ISO 8601 format
+    One page of Zoho contacts with getRecords, least recently modified first.
+    :param from_index: 1-based position of the first contact of the page
+    :param modified_since: Zoho `Modified Time`, only contacts modified since are listed; None for all
+    :return: list of contacts indexed by field name, shorter than page_size on the last page
     """
+    params = {'authtoken': CRM_KEY, 'scope': 'crmapi', 'fromIndex': from_index, 'toIndex': from_index + page_size - 1,
+              'sortColumnString': 'Modified Time', 'sortOrderString': 'asc'}
+    if modified_since:
+        params['lastModifiedTime'] = modified_since
+    zhContacts = http_session.get('https://crm.zoho.com/crm/private/json/Contacts/getRecords', params=params)
+    if zhContacts.status_code != 200:
+        raise RuntimeError(u'Zoho getRecords failed, status: {0}, message: {1}'.format(zhContacts.status_code, zhContacts.content))
+    data = zhContacts.json()
+    error = data.get('response', {}).get('error')
+    if error: #only a `nodata` response means there are no more contacts
+        raise RuntimeError(u'Zoho getRecords failed, code: {0}, message: {1}'.format(error.get('code'), error.get('message')))
+    return zoho_records(data)
+
+def changed_zoho_contacts(modified_since=None, page_size=CRM_PAGE_SIZE):
+    """
+    Page through the Zoho contacts modified since a high-water mark, least recently modified first.
+    Each page starts CRM_MODIFIED_OVERLAP before the latest `Modified Time` read so far rather
+    than at a running index: a contact modified during the pull moves to the end of the list,
+    which would shift the contacts after it past an index. Only when a whole page falls in the
+    overlap does the index move on, one contact short of a page so that a shift shows; the
+    high-water mark then stays at the overlap for the next run to read it again.
+    :param modified_since: Zoho `Modified Time` of the last contact pulled before, None to pull every contact
+    :return: generator of (new contacts indexed by field name, high-water mark once they are pushed), one per page
+    """
+    window = zoho_time_before(modified_since, CRM_MODIFIED_OVERLAP) if modified_since else None
+    from_index = 1
+    last = None #(id, Modified Time) of the last contact of the previous page
+    ceiling = None #start of a window contacts may have been skipped in
+    seen = {} #contact id -> Modified Time, of the contacts the window reads again
+    while True:
+        with metrics.stage('crm'):
+            records = fetch_zoho_page(from_index, window, page_size)
+        listed = [(record.get('CONTACTID'), record['Modified Time']) for record in records]
+        if from_index > 1 and last not in listed: #contacts before the index left the window
+            ceiling = ceiling or window
+        if not records:
+            return
+        mark = max(modified for _, modified in listed)
+        yield [record for record, (id, modified) in zip(records, listed) if seen.get(id) != modified], min(ceiling or mark, mark)
+        if len(records) < page_size:
+            return
+        seen.update(listed)
+        last = listed[-1]
+        next_window = zoho_time_before(mark, CRM_MODIFIED_OVERLAP)
+        if window is None or next_window > window:
+            window, from_index = next_window, 1
+            seen = dict((id, modified) for id, modified in seen.iteritems() if modified >= window)
+        else:
+            from_index += page_size - 1
+
+def zoho_time_before(modified, seconds):
+    """
+    The Zoho `Modified Time` this many seconds before another.
+    """
+    return (datetime.strptime(modified, CRM_TIME_FORMAT) - timedelta(seconds=seconds)).strftime(CRM_TIME_FORMAT)
+
+def search_zoho_email(email):
+    zhContact = http_session.get('https://crm.zoho.com/crm/private/json/Contacts/searchRecords?authtoken=' + CRM_KEY + '&scope=crmapi&criteria=(email:' + email + ')')
+    if zhContact.status_code != 200:
+        raise RuntimeError(u'Zoho contact search failed, status: {0}, message: {1}'.format(zhContact.status_code, zhContact.content))
+    data = zhContact.json()
 
-    if timestamp is None:
+    records = zoho_records(data)
+    if not records:
+        logger.info("miss on email")
         return None
-    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
+    return records[0]
+
+def search_zoho_id(id):
+    zhContact = http_session.get('https://crm.zoho.com/crm/private/json/Contacts/getSearchRecordsByPDC?authtoken='+ CRM_KEY + '&scope=crmapi&searchColumn=contactid&searchValue=' + id)
+    if zhContact.status_code != 200:
+        raise RuntimeError(u'Zoho contact search failed, status: {0}, message: {1}'.format(zhContact.status_code, zhContact.content))
+    data = zhContact.json()
 
+    records = zoho_records(data)
+    if not records:
+        logger.info("miss on id")
+        return None
+    return records[0]
 
 if __name__ == '__main__':
     """
@@ -201,7 +488,18 @@ if __name__ == '__main__':
     `> python aws-zoho.py ticket_created -id 1832093000000383491`
     `> python aws-zoho.py ticket_created -id fsmith@example.com`
     `> python aws-zoho.py session -idfa AEBE52E7-03EE-455A-B3C4-E57283966239`
+    `> python aws-zoho.py flush`
+    `> python aws-zoho.py bulk [--full]`
     """
+    logging.basicConfig(level=logging.INFO)
+
+    if sys.argv[1] == 'flush':
+        print(flush_handler({}, None))
+        sys.exit(0)
+
+    if sys.argv[1] == 'bulk':
+        print(bulk_sync_handler({u'full': '--full' in sys.argv[2:]}, None))
+        sys.exit(0)
 
     # Parse command line arguments
     event_type = unicode(sys.argv[1])
@@ -211,12 +509,10 @@ if __name__ == '__main__':
         id = unicode(sys.argv[3])
     elif sys.argv[2] == '-idfa':
         IDFA = unicode(sys.argv[3])
-    timestamp = unicode(sys.argv[4]) if len(sys.argv) == 5 else None
 
     # Invoke AWS Lambda Function handler
     lambda_handler({
         u'event_type': event_type,
         u'id': id,
-        u'IDFA': IDFA,
-        u'timestamp': timestamp
+        u'IDFA': IDFA
     }, None)
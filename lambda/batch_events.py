@@ -0,0 +1,135 @@
+"""
+Batch entry point support for sync events delivered through SQS or Kinesis.
+With a queue or stream in front of the function, one invocation receives a
+`Records` array of sync events (the same `event_type`, `id`, `IDFA`, `timestamp`
+dicts lambda_handler takes, as the SQS message body or the Kinesis data). The
+events are grouped by customer, so a customer appearing many times in a burst is
+looked up and pushed once, the CRM lookups run concurrently, and all changed
+customers go out in one sync_customers post.
+The handler reports partial batch failures (`batchItemFailures`), so only the
+records of customers that could not be looked up or posted are delivered again;
+enable ReportBatchItemFailures on the event source mapping.
+Include this file in the deployment package next to the Lambda function.
+"""
+import base64
+import json
+import time
+
+import metrics
+from sync_state import customer_key
+
+# Concurrent CRM lookups per batch, the default SQS batch size
+BATCH_CONCURRENCY = 10
+# Customers synced less than this many seconds ago are skipped, as lambda_handler does
+SYNC_WINDOW = 10
+
+
+def batch_items(event):
+    """
+    Decode the records of an SQS or Kinesis batch.
+    :return: (list of (item identifier, sync event dict), identifiers of records that could not be decoded)
+    """
+    items = []
+    undecodable = []
+    for record in event['Records']:
+        if 'kinesis' in record:
+            identifier = record['kinesis']['sequenceNumber']
+            body = lambda: base64.b64decode(record['kinesis']['data'])
+        else:
+            identifier = record['messageId']
+            body = lambda: record['body']
+        try:
+            sync_event = json.loads(body())
+            if not isinstance(sync_event, dict):
+                raise ValueError("sync event is not an object")
+        except (ValueError, TypeError):
+            undecodable.append(identifier)
+            continue
+        items.append((identifier, sync_event))
+    return items, undecodable
+
+
+def fetch_concurrently(func, args, concurrency=BATCH_CONCURRENCY):
+    """
+    Call func on every arg from a pool of threads.
+    :return: list of (result, exception) in the order of args
+    """
+    def call(arg):
+        try:
+            return func(arg), None
+        except Exception as e:
+            return None, e
+    if len(args) <= 1:
+        return [call(arg) for arg in args]
+    from multiprocessing.pool import ThreadPool #heavy, and single events never need it
+    pool = ThreadPool(min(concurrency, len(args)))
+    try:
+        return pool.map(call, args)
+    finally:
+        pool.close()
+
+
+def sync_batch(event, lookup, post, sync_state, logger, window=SYNC_WINDOW, normalize_id=None, record_key=None):
+    """
+    Sync the customers of a batch of sync events.
+    :param lookup: function taking a list of (key, id, IDFA), one per customer, and returning
+        (key, customer dict or None if not found, exception or None) triples
+    :param post: function posting {'customers': [...]}, raising when the post fails
+    :param sync_state: SyncState of the function
+    :param normalize_id: optional function giving the form of an event id the other entry points key customers by
+    :param record_key: optional function giving the key of a found customer dict, for CRMs whose events
+        may name a customer by something other than that key (an email); the recent-sync skip then
+        happens after the lookup
+    :return: the partial batch response, listing the records to deliver again
+    """
+    items, failed = batch_items(event)
+    metrics.add('records', len(event['Records']))
+    customers = {}
+    for identifier, sync_event in items:
+        id = sync_event.get('id')
+        if id and normalize_id is not None:
+            id = normalize_id(id)
+        key = customer_key(id, sync_event.get('IDFA'))
+        if key is None:
+            continue
+        id, IDFA, identifiers = customers.get(key, (id, None, []))
+        customers[key] = (id, sync_event.get('IDFA') or IDFA, identifiers + [identifier])
+
+    now = time.time()
+    def synced_recently(key):
+        last_synced = sync_state.last_synced(key)
+        return last_synced is not None and now - last_synced[0] < window
+    wanted = [(key, id, IDFA) for key, (id, IDFA, _) in customers.iteritems()
+              if record_key is not None or not synced_recently(key)]
+    logger.info("batch of {0} records, {1} customers, {2} to look up".format(len(event['Records']), len(customers), len(wanted)))
+
+    found = []
+    found_identifiers = {} #key of a found customer -> identifiers of the records naming it
+    with metrics.stage('lookup'):
+        for key, customer, error in lookup(wanted):
+            if error is not None:
+                logger.warning("lookup of {0} failed: {1!r}".format(key, error))
+                failed.extend(customers[key][2])
+            elif customer is not None:
+                identifiers = customers[key][2]
+                if record_key is not None:
+                    key = record_key(customer)
+                    if key is not None and key in found_identifiers: #named by several events, by its id and by its email
+                        found_identifiers[key].extend(identifiers)
+                        continue
+                    if key is not None and synced_recently(key):
+                        continue
+                found_identifiers[key] = list(identifiers)
+                found.append((key, customer))
+
+    changed, synced = sync_state.changed(found)
+    if changed:
+        try:
+            post({u'customers': changed})
+            sync_state.mark_synced(synced)
+        except Exception as e:
+            logger.warning("batch sync post failed: {0!r}".format(e))
+            for key, _ in synced:
+                failed.extend(found_identifiers[key])
+    metrics.add('failed_records', len(failed))
+    return {u'batchItemFailures': [{u'itemIdentifier': identifier} for identifier in failed]}
@@ -0,0 +1,127 @@
+"""
+Shared HTTP client for the sync scripts.
+Every request goes through one module-scoped requests.Session, so connections to the
+UserCare sync host and to the CRM hosts are kept alive and reused instead of paying a
+new TCP+TLS handshake per call. In AWS Lambda the module survives between invocations
+of a warm container, so later events reuse the connections opened by earlier ones.
+Include this file in the deployment package next to the Lambda function.
+`ETL/loadSync.py` picks it up from this directory as well.
+Request bodies posted with compress=True (the sync_customers posts) are gzipped
+when they are at least GZIP_MIN_BYTES long and sent with `Content-Encoding: gzip`.
+Requests given a limiter (see rate_limit.py) wait for it before they go out and
+report their status and latency back to it.
+requests is imported when the session is first built, not with this module: it is
+the bulk of a cold start's import time, and a Lambda invocation that only queues or
+skips its event never makes a request.
+"""
+import threading
+import zlib
+
+from rate_limit import parse_retry_after
+
+# Settings for the connection pool, change them with configure()
+# Number of hosts to keep pools for (sync host plus CRM hosts)
+POOL_CONNECTIONS = 4
+# Connections kept alive per host, raise it to the number of concurrent callers
+POOL_MAXSIZE = 10
+# (connect, read) timeouts in seconds applied when the caller does not pass one
+TIMEOUT = (3.05, 30)
+# Connection-level retries done by urllib3, before any request data is sent
+RETRIES = 2
+# Gzip request bodies posted with compress=True, set to False if the server rejects them
+GZIP_REQUESTS = True
+# Bodies smaller than this are sent as they are, compressing them saves next to nothing
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+_session = None
+_lock = threading.Lock()
+
+
+def configure(pool_connections=None, pool_maxsize=None, timeout=None, retries=None):
+    """
+    Change the pool settings. The shared session is rebuilt on next use.
+    :param pool_connections: number of hosts to keep connection pools for
+    :param pool_maxsize: connections kept alive per host
+    :param timeout: default (connect, read) timeout in seconds
+    :param retries: connection-level retries per request
+    """
+    global POOL_CONNECTIONS, POOL_MAXSIZE, TIMEOUT, RETRIES, _session
+    with _lock:
+        if pool_connections is not None:
+            POOL_CONNECTIONS = pool_connections
+        if pool_maxsize is not None:
+            POOL_MAXSIZE = pool_maxsize
+        if timeout is not None:
+            TIMEOUT = timeout
+        if retries is not None:
+            RETRIES = retries
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """
+    Return the shared session, creating it on first use.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from requests.packages.urllib3.util.retry import Retry
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                      max_retries=Retry(total=RETRIES, read=0, status=0, backoff_factor=0.1))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def gzip_body(data, headers=None):
+    """
+    Gzip a request body if it is big enough to be worth it.
+    :return: (body, headers) to send, headers gain `Content-Encoding: gzip` when compressed
+    """
+    if not GZIP_REQUESTS or not isinstance(data, basestring) or len(data) < GZIP_MIN_BYTES:
+        return data, headers
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) #gzip container
+    headers = dict(headers or {})
+    headers['Content-Encoding'] = 'gzip'
+    return compressor.compress(data) + compressor.flush(), headers
+
+
+def request(method, url, compress=False, limiter=None, **kwargs):
+    """
+    Same as requests.request, over the shared keep-alive session.
+    :param compress: gzip the body with gzip_body
+    :param limiter: optional rate_limit.AdaptiveLimiter the request goes through
+    """
+    kwargs.setdefault('timeout', TIMEOUT)
+    if compress:
+        kwargs['data'], kwargs['headers'] = gzip_body(kwargs.get('data'), kwargs.get('headers'))
+    if limiter is None:
+        return get_session().request(method, url, **kwargs)
+    started = limiter.acquire()
+    response = None
+    try:
+        response = get_session().request(method, url, **kwargs)
+        return response
+    finally:
+        if response is None:
+            limiter.release(started)
+        else:
+            limiter.release(started, response.status_code, parse_retry_after(response.headers.get('retry-after')))
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, compress=False, limiter=None, **kwargs):
+    return request('POST', url, compress=compress, limiter=limiter, data=data, **kwargs)
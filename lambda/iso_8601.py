@@ -0,0 +1,133 @@
+"""
+ISO 8601 timestamp codec shared by the sync scripts.
+The sync API takes UTC timestamps as `YYYY-MM-DDTHH:MM:SS.mmmZ`. Parsing slices the
+fields at their fixed positions instead of going through strptime, and accepts the
+variants other systems send: no or 1-6 fraction digits, a space instead of `T`,
+`Z`, `+HH:MM`, `+HHMM` or `+HH` offsets (converted to UTC), no zone (taken as UTC)
+and plain dates. Results for the values seen most often, like the constant
+`first_session`, are cached.
+Include this file in the deployment package next to the Lambda function.
+`ETL/loadSync.py` picks it up from this directory as well.
+"""
+from datetime import datetime, timedelta, tzinfo
+
+# Number of parsed timestamps kept, the cache is emptied when it fills up
+PARSE_CACHE_SIZE = 1024
+
+
+class UtcTZInfo(tzinfo):
+    """
+    UTC timezone used for timestamps.
+    """
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def __repr__(self):
+        return 'UTC'
+
+UTC = UtcTZInfo()
+
+_parse_cache = {}
+_last_formatted = (None, None)
+
+
+def parse_offset(zone):
+    """
+    Offset east of UTC of a `+HH:MM`, `+HHMM` or `+HH` zone designator.
+    """
+    if len(zone) == 6 and zone[3] == ':':
+        minutes = int(zone[1:3]) * 60 + int(zone[4:6])
+    elif len(zone) == 5:
+        minutes = int(zone[1:3]) * 60 + int(zone[3:5])
+    elif len(zone) == 3:
+        minutes = int(zone[1:3]) * 60
+    else:
+        raise ValueError("Invalid UTC offset: %r" % (zone,))
+    return timedelta(minutes=minutes if zone[0] == '+' else -minutes)
+
+
+def parse(timestamp):
+    """
+    Parse an ISO 8601 timestamp without looking at the cache.
+    :return: UTC datetime, None if the string is not shaped like an ISO 8601 timestamp
+    :raise ValueError: for an ISO 8601 shaped string with out of range fields
+    """
+    if len(timestamp) == 10:
+        if timestamp[4] != '-' or timestamp[7] != '-':
+            return None
+        return datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]), tzinfo=UTC)
+    if (len(timestamp) < 19 or timestamp[4] != '-' or timestamp[7] != '-' or timestamp[10] not in 'T '
+            or timestamp[13] != ':' or timestamp[16] != ':'):
+        return None
+    end = len(timestamp)
+    offset = None
+    if timestamp[-1] == 'Z':
+        end -= 1
+    else:
+        sign = max(timestamp.rfind('+', 19), timestamp.rfind('-', 19))
+        if sign != -1:
+            offset = parse_offset(timestamp[sign:])
+            end = sign
+    microsecond = 0
+    if end > 19:
+        fraction = timestamp[20:end]
+        if timestamp[19] != '.' or not 1 <= len(fraction) <= 6 or not fraction.isdigit():
+            return None
+        microsecond = int(fraction.ljust(6, '0'))
+    value = datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                     int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]), microsecond, UTC)
+    if offset:
+        value -= offset
+    return value
+
+
+def parse_iso_8601_timestamp(timestamp):
+    """
+    Parse ISO 8601 formatted timestamp strings.
+    :param timestamp: timestamp in ISO 8601 format, UTC unless it carries an offset
+    :return: UTC datetime timestamp, None if timestamp is None or not ISO 8601
+    """
+    if timestamp is None:
+        return None
+    value = _parse_cache.get(timestamp)
+    if value is None:
+        value = parse(timestamp)
+        if value is None:
+            return None
+        if len(_parse_cache) >= PARSE_CACHE_SIZE:
+            _parse_cache.clear()
+        _parse_cache[timestamp] = value
+    return value
+
+
+def format_iso_8601_timestamp(timestamp):
+    """
+    Format datetime ISO 8601 formatted timestamp strings.
+    :param timestamp: UTC datetime timestamp, aware datetimes in other zones are converted to UTC
+    :return: UTC timestamp in ISO 8601 format, milliseconds truncated
+    """
+    global _last_formatted
+    if timestamp is None:
+        return None
+    last, formatted = _last_formatted
+    if timestamp is last:
+        return formatted
+    value = timestamp
+    if value.tzinfo is not None:
+        if value.tzinfo is not UTC:
+            offset = value.utcoffset()
+            if offset:
+                value = value - offset
+        value = value.replace(tzinfo=None)
+    # The naive isoformat() is the cheapest way to the digits, it leaves out a zero fraction
+    formatted = value.isoformat()
+    formatted = formatted[:23] + 'Z' if value.microsecond else formatted + '.000Z'
+    _last_formatted = (timestamp, formatted)
+    return formatted
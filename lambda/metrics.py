@@ -0,0 +1,224 @@
+"""
+Per-invocation timing and metrics for the Lambda handlers.
+A handler wrapped with @instrumented() records how long each stage of the invocation
+took (token, crm, build, serialize, post, plus the total) and counters like the
+payload size, and writes them as one CloudWatch Embedded Metric Format (EMF) JSON
+line to stdout when it returns, so CloudWatch turns the log line into metrics.
+Code anywhere below the handler records into the current invocation with
+`with metrics.stage('post'):` and `metrics.add('payload_bytes', n, 'Bytes')`;
+outside an instrumented invocation, or with metrics disabled, both do nothing.
+A share of invocations can also be profiled by sampling the handler's stack every
+PROFILE_INTERVAL seconds; the most frequent stacks are added to the record.
+Include this file in the deployment package next to the Lambda function.
+"""
+import collections
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# Settings, change them with configure()
+METRICS_ENABLED = True
+# CloudWatch namespace the metrics are published under
+METRICS_NAMESPACE = 'UserCareSync'
+# Where the EMF records are written, Lambda sends stdout to CloudWatch Logs
+METRICS_STREAM = sys.stdout
+# Share of invocations profiled by stack sampling, 0 turns the profiler off
+PROFILE_RATE = 0.0
+# Seconds between stack samples
+PROFILE_INTERVAL = 0.005
+# Number of most frequent stacks kept in the record
+PROFILE_TOP = 20
+
+_current = None
+_lock = threading.Lock()
+
+
+def configure(enabled=None, namespace=None, stream=None, profile_rate=None, profile_interval=None):
+    """
+    Change the metrics settings.
+    :param enabled: False turns all recording and output off
+    :param stream: file object receiving the EMF records
+    :param profile_rate: share of invocations to profile, from 0 to 1
+    """
+    global METRICS_ENABLED, METRICS_NAMESPACE, METRICS_STREAM, PROFILE_RATE, PROFILE_INTERVAL
+    if enabled is not None:
+        METRICS_ENABLED = enabled
+    if namespace is not None:
+        METRICS_NAMESPACE = namespace
+    if stream is not None:
+        METRICS_STREAM = stream
+    if profile_rate is not None:
+        PROFILE_RATE = profile_rate
+    if profile_interval is not None:
+        PROFILE_INTERVAL = profile_interval
+
+
+class NoStage(object):
+    """
+    Stage context manager used when nothing is being recorded.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_STAGE = NoStage()
+
+
+class Stage(object):
+    """
+    Context manager adding the time spent in its block to a stage of an invocation.
+    """
+
+    def __init__(self, invocation, name):
+        self.invocation = invocation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.invocation.add(self.name + '_ms', (time.time() - self.start) * 1000, 'Milliseconds')
+        return False
+
+
+class StackSampler(object):
+    """
+    Sampling profiler: a thread recording the stack of another thread every interval seconds.
+    Stacks are kept collapsed (`file:function;file:function;...`, outermost first), as
+    flame graph tools read them.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self, top=PROFILE_TOP):
+        """
+        :return: the top most sampled stacks, as [collapsed stack, samples] pairs
+        """
+        self.stopped.set()
+        self.thread.join()
+        return [[stack, count] for stack, count in self.stacks.most_common(top)]
+
+
+class Invocation(object):
+    """
+    Metrics of one handler invocation. Values added under the same name are summed.
+    """
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.values = collections.OrderedDict()
+        self.units = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.sampler = None
+
+    def add(self, name, value, unit='Count'):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def record(self):
+        """
+        :return: the EMF record of the invocation
+        """
+        record = dict(self.dimensions)
+        record.update(self.values)
+        record['_aws'] = {
+            'Timestamp': int(self.start * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in self.values],
+            }],
+        }
+        return record
+
+
+def stage(name):
+    """
+    Time a block as a stage of the current invocation, `with stage('post'): ...`.
+    """
+    invocation = _current
+    if invocation is None:
+        return NO_STAGE
+    return Stage(invocation, name)
+
+
+def add(name, value, unit='Count'):
+    """
+    Add to a counter of the current invocation.
+    """
+    invocation = _current
+    if invocation is not None:
+        invocation.add(name, value, unit)
+
+
+def function_name(context):
+    return getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME') or 'local'
+
+
+def instrumented(operation=None):
+    """
+    Decorator recording the metrics of a Lambda handler and writing them when it returns or raises.
+    :param operation: value of the `operation` dimension, the event's `event_type` by default
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current
+            if not METRICS_ENABLED or _current is not None: #disabled, or called from an instrumented handler
+                return handler(event, context)
+            invocation = Invocation({
+                'function': function_name(context),
+                'operation': operation or (event or {}).get('event_type', 'session'),
+            })
+            invocation.add('errors', 0)
+            if PROFILE_RATE and random.random() < PROFILE_RATE:
+                invocation.sampler = StackSampler(threading.current_thread().ident, PROFILE_INTERVAL).start()
+            _current = invocation
+            try:
+                return handler(event, context)
+            except Exception:
+                invocation.add('errors', 1)
+                raise
+            finally:
+                _current = None
+                invocation.add('total_ms', (time.time() - invocation.start) * 1000, 'Milliseconds')
+                record = invocation.record()
+                if invocation.sampler is not None:
+                    record['profile'] = invocation.sampler.stop()
+                with _lock:
+                    METRICS_STREAM.write(json.dumps(record) + '\n')
+                    METRICS_STREAM.flush()
+        return wrapper
+    return decorate
@@ -0,0 +1,241 @@
+"""
+Client-side rate limiting and adaptive concurrency for the sync API.
+An AdaptiveLimiter combines a token bucket, which caps requests at `rate` per
+second with bursts of up to `burst`, and an AIMD controller for the number of
+requests in flight. Every response that comes back in time and unthrottled adds
+INCREASE to the limit per limit's worth of responses. A 429/503, a request that
+got no response or a slow response multiplies it by DECREASE_FACTOR, at most
+once per round trip. A response is slow when both it and the moving average of
+the latency are above the target, which defaults to LATENCY_TOLERANCE times the
+fastest response seen but never less than LATENCY_FLOOR. A Retry-After sent with a
+429/503 also pauses every caller of the limiter until it has passed, so a burst
+of callers backs off together instead of retrying into the throttle.
+The state lives in memory and is shared by the threads using the limiter; with
+a SQLiteLimiterState it is shared with the other processes on the host too.
+Pass the limiter to http_session.request(..., limiter=limiter) to apply it.
+Include this file in the deployment package next to the Lambda function.
+`ETL/loadSync.py` picks it up from this directory as well.
+"""
+import errno
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Statuses telling that the server is overloaded
+THROTTLE_STATUSES = (429, 503)
+# Factor applied to the concurrency limit on overload
+DECREASE_FACTOR = 0.5
+# Requests added to the concurrency limit per limit's worth of good responses
+INCREASE = 1.0
+# Responses slower than this many times the fastest one seen count as overload
+LATENCY_TOLERANCE = 3.0
+# Lowest default latency target in seconds, faster responses are never slow
+LATENCY_FLOOR = 0.05
+# Weight of the latest response in the moving average of the latency
+LATENCY_SMOOTHING = 0.2
+# Longest pause honoured for a Retry-After, in seconds
+MAX_PAUSE = 60.0
+# Seconds between checks of a caller waiting for a free slot
+POLL_INTERVAL = 0.01
+# Location of the shared state database, /tmp is the writable area in AWS Lambda
+LIMITER_STATE_DB = '/tmp/usercare-rate-limit.db'
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a Retry-After header, given either as delta-seconds or an HTTP-date.
+    :return: seconds to wait, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    import email.utils #only needed for the rare HTTP-date form
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, email.utils.mktime_tz(parsed) - now)
+
+
+class LimiterState(object):
+    """
+    Limiter state shared by the threads of one process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = None
+
+    def update(self, func, initial):
+        """
+        Apply func to the state values under the lock.
+        :param initial: function returning the values to start from
+        :return: what func returns
+        """
+        with self.lock:
+            if self.values is None:
+                self.values = initial()
+            return func(self.values)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class SQLiteLimiterState(object):
+    """
+    Limiter state in a SQLite database, shared by the processes on the host using the
+    same file and name. Requests in flight are counted per process, the counts of
+    processes that are gone are dropped.
+    """
+
+    def __init__(self, path=LIMITER_STATE_DB, name='sync'):
+        self.path = path
+        self.name = name
+        self.lock = threading.Lock()
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=OFF') #the state is worthless after a crash anyway
+            self.db.execute('CREATE TABLE IF NOT EXISTS limiter_state (name TEXT PRIMARY KEY, state TEXT)')
+        return self.db
+
+    def update(self, func, initial):
+        """
+        Apply func to the state values in one write transaction.
+        :param initial: function returning the values to start from
+        :return: what func returns
+        """
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT state FROM limiter_state WHERE name = ?', (self.name,)).fetchone()
+                values = json.loads(row[0]) if row else initial()
+                in_flight = values['in_flight']
+                for pid in list(in_flight):
+                    if not process_alive(int(pid)):
+                        del in_flight[pid]
+                result = func(values)
+                db.execute('INSERT OR REPLACE INTO limiter_state (name, state) VALUES (?, ?)',
+                           (self.name, json.dumps(values)))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            return result
+
+
+class AdaptiveLimiter(object):
+    """
+    Token bucket plus AIMD concurrency limit, see the module docstring.
+    :param max_concurrency: upper bound of the concurrency limit, and where it starts
+    :param rate: requests per second allowed, None for no rate limit
+    :param burst: requests allowed at once after a quiet period, one second's worth by default
+    :param latency_target: seconds above which responses count as overload,
+        LATENCY_TOLERANCE times the fastest response seen (at least LATENCY_FLOOR) by default
+    :param state: LimiterState (the default) or SQLiteLimiterState
+    """
+
+    def __init__(self, max_concurrency, min_concurrency=1, rate=None, burst=None, latency_target=None,
+                 max_pause=MAX_PAUSE, state=None, clock=time.time, sleep=time.sleep):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 1.0)
+        self.latency_target = latency_target
+        self.max_pause = max_pause
+        self.state = state or LimiterState()
+        self.clock = clock
+        self.sleep = sleep
+        self.pid = str(os.getpid())
+
+    def initial(self):
+        return {'limit': float(self.max_concurrency), 'in_flight': {}, 'tokens': self.burst, 'stamp': 0.0,
+                'paused_until': 0.0, 'decreased_at': 0.0, 'min_latency': None, 'latency': None}
+
+    def try_acquire(self, values):
+        """
+        :return: seconds to wait before trying again, 0 once a slot and a token are taken
+        """
+        now = self.clock()
+        if now < values['paused_until']:
+            return values['paused_until'] - now
+        in_flight = values['in_flight']
+        if sum(in_flight.values()) >= int(values['limit']):
+            return POLL_INTERVAL
+        if self.rate:
+            tokens = min(self.burst, values['tokens'] + (now - values['stamp']) * self.rate)
+            values['stamp'] = now
+            if tokens < 1:
+                values['tokens'] = tokens
+                return (1 - tokens) / self.rate
+            values['tokens'] = tokens - 1
+        in_flight[self.pid] = in_flight.get(self.pid, 0) + 1
+        return 0
+
+    def acquire(self):
+        """
+        Wait until the request may go out.
+        :return: start time of the request, to pass to release()
+        """
+        while True:
+            wait = self.state.update(self.try_acquire, self.initial)
+            if wait <= 0:
+                return self.clock()
+            self.sleep(wait)
+
+    def release(self, started, status=None, retry_after=None):
+        """
+        Give back the slot of a finished request and adapt the limit to how it went.
+        :param started: what acquire() returned
+        :param status: HTTP status of the response, None if there was no response
+        :param retry_after: seconds the server asked to wait, if any
+        :return: the concurrency limit
+        """
+        now = self.clock()
+        latency = now - started
+        overloaded = status is None or status in THROTTLE_STATUSES
+
+        def update(values):
+            in_flight = values['in_flight']
+            if in_flight.get(self.pid, 0) > 1:
+                in_flight[self.pid] -= 1
+            else:
+                in_flight.pop(self.pid, None)
+            late = False
+            if not overloaded and status < 400:
+                if values['min_latency'] is None:
+                    values['min_latency'] = values['latency'] = latency
+                values['min_latency'] = min(values['min_latency'], latency)
+                values['latency'] += LATENCY_SMOOTHING * (latency - values['latency'])
+                target = self.latency_target or max(LATENCY_FLOOR, values['min_latency'] * LATENCY_TOLERANCE)
+                late = latency > target and values['latency'] > target
+            if overloaded and retry_after:
+                values['paused_until'] = max(values['paused_until'], now + min(retry_after, self.max_pause))
+            if overloaded or late:
+                if started >= values['decreased_at']: #sent after the last decrease, so it reflects the current limit
+                    values['limit'] = max(self.min_concurrency, values['limit'] * DECREASE_FACTOR)
+                    values['decreased_at'] = now
+            elif status < 400:
+                values['limit'] = min(self.max_concurrency, values['limit'] + INCREASE / values['limit'])
+            return values['limit']
+        return self.state.update(update, self.initial)
+
+    def limit(self):
+        """
+        :return: the current concurrency limit
+        """
+        return self.state.update(lambda values: values['limit'], self.initial)
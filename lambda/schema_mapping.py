@@ -0,0 +1,175 @@
+"""
+Declarative mapping from source records to UserCare customers.
+A mapping is a list of (target, source) or (target, source, type) entries:
+  target  customer key, dotted for nested keys, e.g. u'properties.profile.level'
+  source  column position (negative counts from the end) for rows split from a feed,
+          field name for dict records (missing fields map to None), or Const(value)
+  type    'str' (default, value as is), 'int', 'float', 'bool' or 'timestamp'
+          (normalized to the sync API's ISO 8601 format); empty values map to None
+compile_mapping() turns a mapping into the source of a single function returning
+one nested dict literal and compiles it, so extracting a customer is one call
+with no per-row interpretation of the mapping.
+Include this file in the deployment package next to the Lambda function.
+`ETL/loadSync.py` picks it up from this directory as well.
+"""
+import json
+
+from iso_8601 import format_iso_8601_timestamp, parse_iso_8601_timestamp
+
+TYPES = ('str', 'int', 'float', 'bool', 'timestamp')
+TRUE_VALUES = frozenset([u'1', u'true', u't', u'yes', u'y'])
+
+
+class Const(object):
+    """
+    Mapping source standing for a fixed value.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return 'Const(%r)' % (self.value,)
+
+
+def to_int(value):
+    if value is None or value == u'':
+        return None
+    return int(value)
+
+
+def to_float(value):
+    if value is None or value == u'':
+        return None
+    return float(value)
+
+
+def to_bool(value):
+    if value is None or value == u'':
+        return None
+    if isinstance(value, basestring):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def to_timestamp(value):
+    """
+    Normalize a datetime or ISO 8601 string (see iso_8601.py) to the sync API's
+    `YYYY-MM-DDTHH:MM:SS.mmmZ` (UTC).
+    """
+    if value is None or value == u'':
+        return None
+    if isinstance(value, basestring):
+        parsed = parse_iso_8601_timestamp(value)
+        if parsed is None:
+            raise ValueError("Unsupported timestamp: %r" % (value,))
+        value = parsed
+    return format_iso_8601_timestamp(value)
+
+
+COERCE = {
+    'int': to_int,
+    'float': to_float,
+    'bool': to_bool,
+    'timestamp': to_timestamp,
+}
+
+
+def parse_mapping(mapping):
+    """
+    Validate a mapping.
+    :param mapping: list of (target, source[, type]) entries, lists are accepted as loaded from JSON
+    :return: list of (target path tuple, source, type)
+    """
+    entries = []
+    for entry in mapping:
+        if len(entry) == 2:
+            (target, source), type = entry, 'str'
+        elif len(entry) == 3:
+            target, source, type = entry
+        else:
+            raise ValueError("Mapping entries are (target, source[, type]), got %r" % (entry,))
+        if type not in TYPES:
+            raise ValueError("Unknown type %r for %s, expected one of %s" % (type, target, ', '.join(TYPES)))
+        if not isinstance(source, (int, long, basestring, Const)):
+            raise ValueError("Source of %s must be a column position, a field name or Const, got %r" % (target, source))
+        path = tuple(unicode(target).split(u'.'))
+        for other, _, _ in entries:
+            if path[:len(other)] == other or other[:len(path)] == path:
+                raise ValueError("Target %s clashes with %s" % (target, u'.'.join(other)))
+        entries.append((path, source, type))
+    return entries
+
+
+def mapping_fields(mapping):
+    """
+    Names of the record fields a mapping reads, in mapping order.
+    """
+    return [source for _, source, _ in parse_mapping(mapping) if isinstance(source, basestring)]
+
+
+def mapping_literal(entries, value_code):
+    """
+    Source code of the nested dict literal built by a mapping.
+    Keys are emitted in mapping order, so every literal of the same mapping has the same layout.
+    :param entries: as from parse_mapping
+    :param value_code: function of (entry index, entry) returning the code of the value
+    """
+    tree = []
+    for i, (path, _, _) in enumerate(entries):
+        level = tree
+        for key in path[:-1]:
+            for name, child in level:
+                if name == key:
+                    level = child
+                    break
+            else:
+                child = []
+                level.append((key, child))
+                level = child
+        level.append((path[-1], i))
+
+    def literal(level):
+        return u'{%s}' % u', '.join(u'%r: %s' % (key, literal(value) if isinstance(value, list) else value_code(value, entries[value]))
+                                    for key, value in level)
+    return literal(tree)
+
+
+def compile_mapping(mapping, name='extract'):
+    """
+    Compile a mapping into an extractor function.
+    :return: function taking a row (list) or record (dict) and returning a new customer dict
+    """
+    entries = parse_mapping(mapping)
+    namespace = {'_const': {}, '_coerce': COERCE}
+
+    def value_code(i, (path, source, type)):
+        # Constants are coerced once, here
+        if isinstance(source, Const):
+            namespace['_const'][i] = COERCE[type](source.value) if type != 'str' else source.value
+            return u'_const[%d]' % i
+        if isinstance(source, basestring):
+            code = u'record.get(%r)' % source
+        else:
+            code = u'record[%d]' % source
+        if type != 'str':
+            code = u'_coerce[%r](%s)' % (type, code)
+        return code
+    code = u'def %s(record):\n    return %s\n' % (name, mapping_literal(entries, value_code))
+    exec compile(code, '<mapping %s>' % name, 'exec') in namespace
+    return namespace[name]
+
+
+def load_mapping(path):
+    """
+    Read a mapping from a JSON file: a list of [target, source] or [target, source, type]
+    entries, where a source of {"const": value} stands for Const(value).
+    """
+    with open(path) as mapping_file:
+        mapping = json.load(mapping_file)
+    if not isinstance(mapping, list):
+        raise ValueError("%s must hold a list of mapping entries" % path)
+    for entry in mapping:
+        if isinstance(entry, list) and len(entry) > 1 and isinstance(entry[1], dict):
+            entry[1] = Const(entry[1].get('const'))
+    return mapping
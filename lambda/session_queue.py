@@ -0,0 +1,79 @@
+"""
+Queue of customers seen in `session` events, waiting for a background sync.
+Session events arrive all the time, so instead of a CRM lookup and a one-customer
+sync post per event the Lambda functions record the customer id or IDFA here and a
+scheduled flush drains the queue in large batched sync_customers calls.
+A customer queued many times before the next flush is stored once.
+SQLite stands in for the DynamoDB table a production deployment would use; only
+add() and drain() need replacing to move to it.
+Include this file in the deployment package next to the Lambda function.
+"""
+import sqlite3
+import threading
+import time
+
+# Location of the queue database, /tmp is the writable area in AWS Lambda
+SESSION_QUEUE_DB = '/tmp/usercare-session-queue.db'
+
+
+class SessionQueue(object):
+    """
+    Deduplicated set of (id, IDFA) pairs pending a sync, keyed by id, or by IDFA if there is no id.
+    """
+
+    def __init__(self, path=SESSION_QUEUE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS pending_sessions ('
+                            'key TEXT PRIMARY KEY, id TEXT, idfa TEXT, queued_at REAL)')
+            self.db.commit()
+        return self.db
+
+    def add(self, id, IDFA):
+        """
+        Queue a customer, replacing any earlier entry for the same customer.
+        :return: False if there is neither an id nor an IDFA to queue
+        """
+        if id:
+            key = u'id:' + id
+        elif IDFA:
+            key = u'idfa:' + IDFA
+        else:
+            return False
+        with self.lock:
+            db = self.connect()
+            db.execute('INSERT OR REPLACE INTO pending_sessions (key, id, idfa, queued_at) VALUES (?, ?, ?, ?)',
+                       (key, id, IDFA, time.time()))
+            db.commit()
+        return True
+
+    def drain(self, batch_size):
+        """
+        Hand out queued customers in batches, oldest first.
+        A batch is removed from the queue only when the caller asks for the next one
+        (or the generator finishes), so a batch whose sync raises is kept for the
+        next flush. Entries re-queued while their batch was being synced are kept too.
+        :return: generator of lists of (id, IDFA)
+        """
+        while True:
+            with self.lock:
+                rows = self.connect().execute(
+                    'SELECT key, id, idfa, queued_at FROM pending_sessions ORDER BY queued_at LIMIT ?',
+                    (batch_size,)).fetchall()
+            if not rows:
+                return
+            yield [(id, IDFA) for _, id, IDFA, _ in rows]
+            with self.lock:
+                db = self.connect()
+                db.executemany('DELETE FROM pending_sessions WHERE key = ? AND queued_at = ?',
+                               [(key, queued_at) for key, _, _, queued_at in rows])
+                db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connect().execute('SELECT COUNT(*) FROM pending_sessions').fetchone()[0]
@@ -19,15 +19,28 @@ matter of a few seconds.
 `session` event types are called whenever the user creates a new session. As this happens all
 the time it is recommended that you store the customer id or IDFA to one side (maybe in a DynamoDB
 data store) and then periodically process the list and update UserCare in the background.
+This function does exactly that: `session` events only add the customer to a deduplicating
+queue (see session_queue.py) and `flush_handler`, run on a schedule (for example a CloudWatch
+Events rule), syncs everything queued in a few large `sync_customers` calls.
+With SQS or Kinesis in front of the function, `batch_handler` takes a whole batch of
+events instead (see batch_events.py) and syncs each customer in it once, in one
+`sync_customers` call.
 """
 
 import base64
-from datetime import datetime, timedelta, tzinfo
+import batch_events
+from datetime import datetime
 import json
 import logging
-import pytz
-import requests
+import metrics
+import http_session
+from iso_8601 import UTC, format_iso_8601_timestamp
+from rate_limit import AdaptiveLimiter
+from session_queue import SessionQueue
+from schema_mapping import compile_mapping
+from sync_state import SyncState, customer_digest, customer_key
 import sys
+import time
 
 # Settings for the web service connection to update the UserCare user profile
 PUBLISHER_ADMIN_USERNAME = u'CHANGE_THIS_TO_ADMIN_USER_INFO'
@@ -41,11 +54,39 @@ CUSTOMER_SYNC_HOST = u'sync.usercare.com'
 CUSTOMER_SYNC_URL = u'https://' + CUSTOMER_SYNC_HOST + u'/api/v1/' + PUBLISHER_API_KEY + u'/sync_customers'
 # The authentication header for the web service
 HTTP_BASIC_AUTHORIZATION = base64.b64encode(PUBLISHER_ADMIN_USERNAME + u':' + PUBLISHER_ADMIN_PASSWORD)
+# Customers per sync post when flushing queued sessions
+SYNC_BATCH_SIZE = 1000
+# Sync posts per second allowed from one container, None for no limit (see rate_limit.py)
+SYNC_RATE_LIMIT = None
+# Longest wait for a Retry-After of the sync API, keep it well under the function timeout
+SYNC_MAX_PAUSE = 2
+# Mapping of your customer record fields to UserCare customer keys and custom properties (see schema_mapping.py)
+CUSTOMER_MAPPING = [
+    (u'id', 'id'),
+    (u'gender', 'gender'),
+    (u'email', 'email'),
+    (u'age', 'age', 'int'),
+    (u'first_name', 'first_name'),
+    (u'last_name', 'last_name'),
+    (u'interests', 'interests'),
+    (u'cost', 'cost', 'int'),
+    (u'ltv', 'ltv', 'float'),
+    (u'first_session', 'first_session', 'timestamp'),
+    (u'properties.primary_platform', 'platform'),
+    (u'properties.profile.level', 'level'),
+    (u'properties.profile.points', 'points', 'int'),
+]
 
 # Logging - reduce level to WARNING or ERROR for production
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+session_queue = SessionQueue()
+extract_customer = compile_mapping(CUSTOMER_MAPPING, 'extract_customer')
+sync_state = SyncState()
+sync_limiter = AdaptiveLimiter(http_session.POOL_MAXSIZE, rate=SYNC_RATE_LIMIT, max_pause=SYNC_MAX_PAUSE)
+
+@metrics.instrumented()
 def lambda_handler(event, context):
     """
     AWS Lambda Function main entry point.
@@ -53,7 +94,7 @@ def lambda_handler(event, context):
     event_type - Event type triggering invocation, 'session' or 'ticket_created'.
     id - Externally defined customer id set via SDK or customer sync, optional.
     IDFA - Device identification supplied if id not set, optional.
-    timestamp - Customer sync timestamp, ('2016-01-01T00:00:00.000Z', UTC), optional.
+    timestamp - Customer sync timestamp, ignored: the last sync is read from the sync state (see sync_state.py).
     When the UserCare server sends these events all the fields will be present.
     However, some of the values may be set to None in the event. Your code should
     check for that an handle accordingly.
@@ -63,120 +104,158 @@ def lambda_handler(event, context):
     event_type = event.get('event_type','session')
     id = event.get('id',None)
     IDFA = event.get('IDFA',None)
-    timestamp = parse_iso_8601_timestamp(event.get('timestamp',u'2016-05-29T11:45:13.381Z'))
 
     logger.info("got event: " + json.dumps(event))
 
-    # Check that the timestamp of last sync update was more than 5 minutes ago and if it was, skip it
-    customer_sync_data_timestamp = pytz.UTC.localize(datetime.now())
-    if timestamp is not None and (customer_sync_data_timestamp-timestamp).total_seconds() < 300:
+    # Skip the customer if our last sync of it was less than 5 minutes ago (see sync_state.py)
+    customer_sync_data_timestamp = datetime.now(UTC)
+    key = customer_key(id, IDFA)
+    last_synced = sync_state.last_synced(key) if key else None
+    if last_synced is not None and time.time() - last_synced[0] < 300:
         logger.info("Last update was less than 5 minutes ago")
         return
 
-    # Get customer sync data, (hardcoded data example)
-    # Your implementation will need to retrieve data from a service on your servers
-    customer_sync_data = {
-        u'customers': [{
-            u'id': id,
-            u'IDFA': IDFA,
-            u'gender': u'M',
-            u'email': u'jdoe@nowhere.org',
-            u'age': 40,
-            u'first_name': u'John',
-            u'last_name': u'Doe',
-            u'interests': u'poker, Sharks, NHL, MLB, SF Giants',
-            u'cost': 105,
-            u'ltv': 45.67,
-            u'first_session': format_iso_8601_timestamp(parse_iso_8601_timestamp(u'2016-01-01T00:00:00.000Z')),
-            u'properties': {
-                u'primary_platform': u'iOS',
-                u'profile': {
-                    u'level': u'novice',
-                    u'points': 150
-                }
-            },
-            u'timestamp': format_iso_8601_timestamp(customer_sync_data_timestamp)
-        }]
-    }
-
-    # Convert the data structure to JSON to post to UserCare
-    customer_sync_data_json = json.dumps(customer_sync_data)
-
-    # Asynchronous sync customer data request
-    response = requests.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json,
-                             headers={
-                                 u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
-                                 u'Content-Type': u'application/json'
-                             })
+    # Session events are synced in the background by flush_handler
+    if event_type == 'session':
+        session_queue.add(id, IDFA)
+        logger.info("Queued session for background sync")
+        return
 
-    # Raise and error back to the Lambda function caller if the sync fails
-    if response.status_code != 200:
-        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.
-                           format(response.status_code, response.content))
+    with metrics.stage('build'):
+        customer = build_customer(id, IDFA, customer_sync_data_timestamp)
+    digest = customer_digest(customer)
+    if last_synced is not None and last_synced[1] == digest:
+        logger.info("Customer data unchanged since last sync")
+        return
 
-    # Check sync customer response to make sure we have no errors
-    response_json = json.loads(response.content)
-    created_count = response_json[u'created_count']
-    updated_count = response_json[u'updated_count']
-    error_count = response_json[u'error_count']
-    # If we do raise an error back to the Lambda function caller
-    if error_count != 0:
-        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    post_customer_sync_data({u'customers': [customer]})
+    if key:
+        sync_state.mark_synced([(key, digest)])
 
     # Send response back to caller
     return None
 
-class UtcTZInfo(tzinfo):
+
+@metrics.instrumented('flush')
+def flush_handler(event, context):
     """
-    UTC timezone used for timestamps.
+    AWS Lambda Function entry point for the scheduled sync of queued `session` events.
+    Returns the summed created/updated/error counts of the sync posts.
     """
 
-    def utcoffset(self, dt):
-        return timedelta(0)
+    customer_sync_data_timestamp = datetime.now(UTC)
+    totals = {u'created_count': 0, u'updated_count': 0, u'error_count': 0}
+    for sessions in session_queue.drain(SYNC_BATCH_SIZE):
+        customers, synced = sync_state.changed((customer_key(id, IDFA), build_customer(id, IDFA, customer_sync_data_timestamp))
+                                               for id, IDFA in sessions)
+        if customers:
+            add_counts(totals, post_customer_sync_data({u'customers': customers}, raise_on_errors=False))
+            sync_state.mark_synced(synced)
+    logger.info("flushed sessions: " + json.dumps(totals))
+    return totals
 
-    def tzname(self, dt):
-        return "UTC"
 
-    def dst(self, dt):
-        return timedelta(0)
+@metrics.instrumented('batch')
+def batch_handler(event, context):
+    """
+    AWS Lambda Function entry point for events delivered in batches by SQS or Kinesis.
+    Accepts the `Records` of the batch, each carrying a lambda_handler event. All events,
+    `session` ones included, are synced straight away.
+    Returns the records to deliver again as `batchItemFailures`.
+    """
 
-UTC = UtcTZInfo()
+    customer_sync_data_timestamp = datetime.now(UTC)
+    def lookup(customers):
+        # A build_customer calling your servers would fan out with batch_events.fetch_concurrently
+        with metrics.stage('build'):
+            return [(key, build_customer(id, IDFA, customer_sync_data_timestamp), None) for key, id, IDFA in customers]
+    post = lambda customer_sync_data: post_customer_sync_data(customer_sync_data, raise_on_errors=False)
+    return batch_events.sync_batch(event, lookup, post, sync_state, logger)
 
 
-def parse_iso_8601_timestamp(timestamp):
+def build_customer(id, IDFA, customer_sync_data_timestamp):
     """
-    Parse ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC timestamp in ISO 8601 format
-    :return: UTC datetime timestamp
+    Get customer sync data, (hardcoded data example)
+    Your implementation will need to retrieve data from a service on your servers,
+    CUSTOMER_MAPPING then maps its fields to the UserCare customer
     """
+    record = {
+        'id': id,
+        'gender': u'M',
+        'email': u'jdoe@nowhere.org',
+        'age': u'40',
+        'first_name': u'John',
+        'last_name': u'Doe',
+        'interests': u'poker, Sharks, NHL, MLB, SF Giants',
+        'cost': u'105',
+        'ltv': u'45.67',
+        'first_session': u'2016-01-01T00:00:00.000Z',
+        'platform': u'iOS',
+        'level': u'novice',
+        'points': u'150',
+    }
+    customer = extract_customer(record)
+    customer[u'IDFA'] = IDFA
+    customer[u'timestamp'] = format_iso_8601_timestamp(customer_sync_data_timestamp)
+    return customer
 
-    if timestamp is None or len(timestamp) != 24 or timestamp[-1] != 'Z':
-        return None
-    return datetime.strptime(timestamp[:-1]+u'000', u'%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=UTC)
 
+def add_counts(totals, counts):
+    for key in totals:
+        totals[key] += counts[key]
 
-def format_iso_8601_timestamp(timestamp):
+
+def post_customer_sync_data(customer_sync_data, raise_on_errors=True):
     """
-    Format datetime ISO 8601 formatted timestamp strings.
-    :param timestamp: UTC datetime timestamp
-    :return: UTC timestamp in ISO 8601 format
+    Post customer sync data to UserCare.
+    :param raise_on_errors: raise if the response reports errors for some customers
+    :return: the created/updated/error counts of the response
     """
 
-    if timestamp is None:
-        return None
-    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
+    # Convert the data structure to JSON to post to UserCare
+    with metrics.stage('serialize'):
+        customer_sync_data_json = json.dumps(customer_sync_data)
+    metrics.add('customers', len(customer_sync_data[u'customers']))
+    metrics.add('payload_bytes', len(customer_sync_data_json), 'Bytes')
+
+    # Asynchronous sync customer data request, gzipped if large (see http_session.py) and paced by sync_limiter
+    with metrics.stage('post'):
+        response = http_session.post(CUSTOMER_SYNC_URL, data=customer_sync_data_json, compress=True, limiter=sync_limiter,
+                                 headers={
+                                     u'Authorization': u'Basic ' + HTTP_BASIC_AUTHORIZATION,
+                                     u'Content-Type': u'application/json'
+                                 })
+
+    # Raise and error back to the Lambda function caller if the sync fails
+    if response.status_code != 200:
+        raise RuntimeError(u'Customer sync post failed, status: {0}, message: {1}'.
+                           format(response.status_code, response.content))
 
+    # Check sync customer response to make sure we have no errors
+    response_json = json.loads(response.content)
+    created_count = response_json[u'created_count']
+    updated_count = response_json[u'updated_count']
+    error_count = response_json[u'error_count']
+    # If we do raise an error back to the Lambda function caller
+    if error_count != 0 and raise_on_errors:
+        raise RuntimeError(u'Customer sync post response errors: {0}'.format(error_count))
+    return response_json
 
 if __name__ == '__main__':
     """
     Command line main entry point.
     Usage:
-    `> python simple-aws-lambda-customer-sync.py <event_type> ( -id <id> | -idfa <IDFA> ) [ <timestamp> ]`
+    `> python simple-aws-lambda-customer-sync.py <event_type> ( -id <id> | -idfa <IDFA> )`
     Examples:
-    `> python simple-aws-lambda-customer-sync.py ticket_created -id simulated-user-0 2016-01-01T00:00:00.000Z`
+    `> python simple-aws-lambda-customer-sync.py ticket_created -id simulated-user-0`
     `> python simple-aws-lambda-customer-sync.py session -idfa AEBE52E7-03EE-455A-B3C4-E57283966239`
+    `> python simple-aws-lambda-customer-sync.py flush`
     """
 
+    if sys.argv[1] == 'flush':
+        print(flush_handler({}, None))
+        sys.exit(0)
+
     # Parse command line arguments
     event_type = unicode(sys.argv[1])
     id = None
@@ -185,12 +264,10 @@ if __name__ == '__main__':
         id = unicode(sys.argv[3])
     elif sys.argv[2] == '-idfa':
         IDFA = unicode(sys.argv[3])
-    timestamp = unicode(sys.argv[4]) if len(sys.argv) == 5 else None
 
     # Invoke AWS Lambda Function handler
     lambda_handler({
         u'event_type': event_type,
         u'id': id,
-        u'IDFA': IDFA,
-        u'timestamp': timestamp
+        u'IDFA': IDFA
     }, None)
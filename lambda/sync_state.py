@@ -0,0 +1,135 @@
+"""
+Index of what was last pushed to UserCare for each customer.
+For every customer id (or IDFA when there is no id) it keeps the time of the last
+successful sync post and a hash of the customer data that was sent. The sync
+scripts use it to skip customers that were pushed moments ago and, once the
+customer data is built, customers whose data has not changed since the last push.
+It also keeps the high-water marks of incremental CRM pulls, next to the hashes, so
+that losing the database means one full pull whose unchanged customers are pushed
+again, never a gap.
+SQLite stands in for the DynamoDB table a production deployment would use; only
+last_synced(), is_unchanged(), mark_synced() and the high-water mark methods need
+replacing to move to it.
+Include this file in the deployment package next to the Lambda function.
+`ETL/loadSync.py` picks it up from this directory as well.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Location of the index database, /tmp is the writable area in AWS Lambda
+SYNC_STATE_DB = '/tmp/usercare-sync-state.db'
+
+
+def customer_key(id, IDFA):
+    """
+    Key of a customer in the index, None if there is neither an id nor an IDFA.
+    """
+    if id:
+        return u'id:' + id
+    if IDFA:
+        return u'idfa:' + IDFA
+    return None
+
+
+def customer_digest(customer):
+    """
+    Hash of a customer dict, leaving out the sync `timestamp` which changes on every push.
+    """
+    data = dict((key, value) for key, value in customer.iteritems() if key != u'timestamp')
+    return hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def record_digest(record):
+    """
+    Hash of a customer already serialized to JSON bytes.
+    """
+    return hashlib.md5(record).hexdigest()
+
+
+class SyncState(object):
+    """
+    Persistent customer key -> (last sync time, data hash) index, safe to share between threads.
+    """
+
+    def __init__(self, path=SYNC_STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                            'key TEXT PRIMARY KEY, synced_at REAL, digest TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS high_water_marks (name TEXT PRIMARY KEY, mark TEXT)')
+            self.db.commit()
+        return self.db
+
+    def last_synced(self, key):
+        """
+        :return: (sync time in epoch seconds, data hash) of the last push, or None
+        """
+        with self.lock:
+            return self.connect().execute('SELECT synced_at, digest FROM sync_state WHERE key = ?',
+                                          (key,)).fetchone()
+
+    def is_unchanged(self, key, digest):
+        """
+        Whether the data with this hash is what was last pushed for the customer.
+        """
+        last = self.last_synced(key)
+        return last is not None and last[1] == digest
+
+    def changed(self, keyed_customers):
+        """
+        Drop the customers whose data is what was last pushed for them.
+        :param keyed_customers: (key, customer dict) pairs
+        :return: (customers to push, (key, data hash) pairs to mark once the push succeeds)
+        """
+        customers = []
+        entries = []
+        for key, customer in keyed_customers:
+            digest = customer_digest(customer)
+            if key is not None and self.is_unchanged(key, digest):
+                continue
+            customers.append(customer)
+            if key is not None:
+                entries.append((key, digest))
+        return customers, entries
+
+    def mark_synced(self, entries, synced_at=None):
+        """
+        Record a successful push.
+        :param entries: (key, data hash) pairs of the customers in the sync post
+        """
+        if synced_at is None:
+            synced_at = time.time()
+        with self.lock:
+            db = self.connect()
+            db.executemany('INSERT OR REPLACE INTO sync_state (key, synced_at, digest) VALUES (?, ?, ?)',
+                           [(key, synced_at, digest) for key, digest in entries])
+            db.commit()
+
+    def high_water_mark(self, name):
+        """
+        :return: the high-water mark saved under this name, None if there is none
+        """
+        with self.lock:
+            row = self.connect().execute('SELECT mark FROM high_water_marks WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water_mark(self, name, mark):
+        """
+        Save how far an incremental pull got, once everything before the mark is pushed.
+        :param mark: string compared and stored as given, None forgets the mark
+        """
+        with self.lock:
+            db = self.connect()
+            if mark is None:
+                db.execute('DELETE FROM high_water_marks WHERE name = ?', (name,))
+            else:
+                db.execute('INSERT OR REPLACE INTO high_water_marks (name, mark) VALUES (?, ?)', (name, mark))
+            db.commit()
@@ -0,0 +1,54 @@
+"""
+Small in-memory LRU cache with per-entry expiry.
+Lives for the life of the module, so in AWS Lambda entries are shared by all the
+invocations handled by a warm container. Safe to use from several threads.
+Include this file in the deployment package next to the Lambda function.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+# Returned by TTLCache.get when the key is absent or expired, so None can be cached
+MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Mapping of at most maxsize entries, each dropped ttl seconds after it was set.
+    The least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the cached value, or MISSING
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                return MISSING
+            self.entries[key] = entry #move to the most recently used end
+            return value
+
+    def put(self, key, value, ttl=None):
+        """
+        Cache value under key for ttl seconds (the cache default if not given).
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()